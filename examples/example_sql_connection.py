@@ -1,35 +1,37 @@
-import sqlite3
-from datetime import datetime, timedelta
+import os
+import sys
+
+# database.py lives next to the stations
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "myfiles"))
+from database import Database
 
 PATH = "../data/flaschen_database.db"
 # Connect to the SQLite database
+db = Database(PATH)
 
-
-conn = sqlite3.connect(PATH)
-cursor = conn.cursor()
-
-data = cursor.execute('''
-    SELECT * from Flasche;
-    
-''')
-
-fetch_result = cursor.fetchall()
-
-for fid_rid_data_error in fetch_result:
-    print(f" Flasche: {fid_rid_data_error[0]}, Rezept : {fid_rid_data_error[1]}, Datum: {fid_rid_data_error[2]}, Fehler : {fid_rid_data_error[3]}")
+# In chunks, memory stays the same however many bottles there are (see myfiles/export.py)
+for chunk in db.flaschen_chunks():
+    for flasche in chunk:
+        print(f" Flasche: {flasche.flaschen_id}, Rezept : {flasche.rezept_id}, Datum: {flasche.tagged_date}, Fehler : {flasche.has_error}")
 
 def update_has_error(flaschen_id, has_error):
     try:
-        cursor.execute("UPDATE Flasche SET has_error = ? WHERE Flaschen_ID = ?", (has_error, flaschen_id))
-        conn.commit()
-        print(f"Updated has_error for Flaschen_ID {flaschen_id} to {has_error}.")
+        if db.set_has_error(flaschen_id, has_error):
+            print(f"Updated has_error for Flaschen_ID {flaschen_id} to {has_error}.")
+        else:
+            print(f"No bottle with Flaschen_ID {flaschen_id}.")
     except Exception as e:
-        conn.rollback()
         print(f"Error occurred while updating has_error for Flaschen_ID {flaschen_id}: {e}")
 
 
 # Example usage: Update has_error for Flaschen_ID 1 to True
 update_has_error(1, True)
 
-# Close the connection
-conn.close()
\ No newline at end of file
+# Many bottles at once, one transaction: by ID or e.g. every bottle of recipe 2 tagged on one day
+result = db.set_has_error_many([2, 3, 4])
+print(f"Flagged {result.changed} of {result.matched} bottles.")
+result = db.set_has_error_where(rezept_id=2, since="2024-01-01", until="2024-01-02")
+print(f"Flagged {result.changed} of {result.matched} bottles of Rezept 2.")
+
+# Close the connections
+db.close()
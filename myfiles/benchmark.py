@@ -0,0 +1,263 @@
+# End-to-end throughput benchmark of the station flows. Every station process
+# drives the real station1.tag_bottle / station2.dispense code through an emulated
+# PN532 against a temporary copy of the database, N processes at a time.
+#
+# Usage: python benchmark.py [--processes 1,2,4] [--bottles 200] [--scenarios station1,station2,mixed]
+#                            [--no-latency] [--output results.json] [--baseline old.json] [--tolerance 0.1]
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import db_migrations
+import metrics
+import nfc_reader
+import pn532_emulator
+import station1
+import station2
+import tag_codec
+from bottle_ids import BottleIdAllocator
+from database import Database
+from db_writer import WriteBehindWriter
+
+logger = logging.getLogger("benchmark")
+
+SCENARIOS = ("station1", "station2", "mixed")
+DEFAULT_PROCESSES = (1, 2, 4)
+DEFAULT_BOTTLES = 200
+DEFAULT_TOLERANCE = 0.1
+READ_TIMEOUT = 1.0
+WORKER_TIMEOUT = 600.0
+
+
+def _roles(scenario, processes):
+    if scenario == "mixed":
+        return ["station1" if i % 2 == 0 else "station2" for i in range(processes)]
+    return [scenario] * processes
+
+
+def _seed_bottles(db_path, count):
+    """Tagged bottles for the station 2 processes, as station 1 would have left them."""
+    conn = sqlite3.connect(db_path)
+    try:
+        rezept_ids = [row[0] for row in conn.execute("SELECT DISTINCT Rezept_ID FROM Rezept_besteht_aus_Granulat")]
+        start = (conn.execute("SELECT MAX(Flaschen_ID) FROM Flasche").fetchone()[0] or 0) + 1
+        ids = list(range(start, start + count))
+        with conn:
+            conn.executemany(
+                "INSERT INTO Flasche (Flaschen_ID, Rezept_ID, Tagged_Date, has_error) VALUES (?, ?, ?, 0)",
+                [(fid, rezept_ids[fid % len(rezept_ids)], datetime.now()) for fid in ids],
+            )
+        return ids
+    finally:
+        conn.close()
+
+
+def _card(index, number, payload=None):
+    card = pn532_emulator.VirtualCard(bytes([0xB0 + index % 16]) + number.to_bytes(3, "big"))
+    if payload is not None:
+        for block_number, data in tag_codec.to_blocks(payload).items():
+            card.set_block(block_number, data)
+    return card
+
+
+def _worker(role, index, db_path, bottles, flaschen_ids, latency, barrier, results):
+    # Per-bottle log lines and prints would measure the console, not the station
+    logging.getLogger().setLevel(logging.WARNING)
+    metrics.enable()
+    pn532 = pn532_emulator.EmulatedPN532(
+        [], latency=pn532_emulator.LatencyModel.typical(seed=index) if latency else None)
+    reader = nfc_reader.NFCReader(pn532)
+    allocator = writer = confirmer = None
+    db = Database(db_path, migrate=False)
+    if role == "station1":
+        cards = [_card(index, number) for number in range(bottles)]
+        allocator = BottleIdAllocator(db)
+        writer = WriteBehindWriter(db)
+        handle = lambda uid: station1.tag_bottle(reader, uid, allocator, writer, db)
+    else:
+        # Tagged the way station 1 tags them
+        cards = []
+        for number, flaschen_id in enumerate(flaschen_ids):
+            rezept_id, mengen = db.lookup(flaschen_id)
+            cards.append(_card(index, number, tag_codec.encode(flaschen_id, rezept_id, mengen)))
+        confirmer = station2.DbConfirmer(db)
+        handle = lambda uid: station2.dispense(reader, db, uid, confirmer)
+
+    times = []
+    failed = 0
+    barrier.wait()
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for card in cards:
+            cycle_start = time.perf_counter()
+            pn532.place_card(card)
+            uid = reader.read_passive_target(timeout=READ_TIMEOUT)
+            # The PN532 returns a bytearray, the service loop hands out bytes
+            ok = uid is not None and handle(bytes(uid))
+            pn532.remove_card()
+            times.append(time.perf_counter() - cycle_start)
+            failed += not ok
+    if writer is not None:
+        # The run is only done once every bottle is committed
+        writer.close()
+        allocator.close()
+    if confirmer is not None:
+        confirmer.close()
+    end = time.time()
+    db.close()
+    reader.close()
+
+    histograms = {name: metrics.histogram(name, "") for name in (
+        "bottle_id_reserve_block_seconds", "db_write_batch_seconds", "recipe_lookup_seconds")}
+    results.put({
+        "role": role,
+        "start": start,
+        "end": end,
+        "times": times,
+        "failed": failed,
+        "db_lock_retries": metrics.counter("db_write_errors_total", "", label="reason").get("locked"),
+        "db_seconds": {name: (h.count, h.total) for name, h in histograms.items()},
+    })
+
+
+def _percentiles(times):
+    if not times:
+        return {}
+    cuts = statistics.quantiles(times if len(times) > 1 else times * 2, n=100, method="inclusive")
+    return {"p50_ms": round(cuts[49] * 1000, 2), "p95_ms": round(cuts[94] * 1000, 2),
+            "p99_ms": round(cuts[98] * 1000, 2)}
+
+
+def _summarize(workers):
+    times = [t for worker in workers for t in worker["times"]]
+    wall = max(worker["end"] for worker in workers) - min(worker["start"] for worker in workers)
+    summary = {
+        "bottles": len(times),
+        "failed": sum(worker["failed"] for worker in workers),
+        "wall_seconds": round(wall, 3),
+        "bottles_per_minute": round(len(times) / wall * 60, 1) if wall > 0 else None,
+        **_percentiles(times),
+        "db_lock_retries": sum(worker["db_lock_retries"] for worker in workers),
+    }
+    for name in workers[0]["db_seconds"]:
+        count = sum(worker["db_seconds"][name][0] for worker in workers)
+        total = sum(worker["db_seconds"][name][1] for worker in workers)
+        if count:
+            summary[name.replace("_seconds", "_mean_ms")] = round(total / count * 1000, 3)
+    return summary
+
+
+def run_scenario(source_db, scenario, processes, bottles, latency):
+    """Run `processes` station processes on a fresh copy of `source_db`."""
+    workdir = tempfile.mkdtemp(prefix="station_bench_")
+    try:
+        db_path = os.path.join(workdir, "flaschen_database.db")
+        shutil.copyfile(source_db, db_path)
+        db_migrations.ensure_schema(db_path)
+        roles = _roles(scenario, processes)
+        seeded = _seed_bottles(db_path, bottles * roles.count("station2"))
+
+        ctx = multiprocessing.get_context("spawn")
+        barrier = ctx.Barrier(processes)
+        results = ctx.Queue()
+        workers = []
+        for index, role in enumerate(roles):
+            flaschen_ids = seeded[:bottles] if role == "station2" else None
+            if role == "station2":
+                seeded = seeded[bottles:]
+            workers.append(ctx.Process(target=_worker, args=(
+                role, index, db_path, bottles, flaschen_ids, latency, barrier, results)))
+        for worker in workers:
+            worker.start()
+        # A crashed worker never reports, do not wait for it forever
+        collected = [results.get(timeout=WORKER_TIMEOUT) for _ in workers]
+        for worker in workers:
+            worker.join()
+
+        result = {"scenario": scenario, "processes": processes, **_summarize(collected)}
+        for role in sorted(set(roles)):
+            result[role] = _summarize([worker for worker in collected if worker["role"] == role])
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Regressions against a previous run: lower throughput or higher p95 beyond `tolerance`."""
+    previous = {(r["scenario"], r["processes"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["scenario"], result["processes"]))
+        if old is None:
+            continue
+        name = f'{result["scenario"]} x{result["processes"]}'
+        if result["bottles_per_minute"] < old["bottles_per_minute"] * (1 - tolerance):
+            regressions.append(f'{name}: {result["bottles_per_minute"]} bottles/min, was {old["bottles_per_minute"]}')
+        if result["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            regressions.append(f'{name}: p95 {result["p95_ms"]} ms, was {old["p95_ms"]}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Station throughput benchmark")
+    parser.add_argument("--db", default=db_migrations.DEFAULT_DB_PATH, help="database to copy")
+    parser.add_argument("--processes", default=",".join(map(str, DEFAULT_PROCESSES)),
+                        help="comma separated numbers of concurrent station processes")
+    parser.add_argument("--bottles", type=int, default=DEFAULT_BOTTLES, help="bottles per process")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--no-latency", action="store_true", help="emulated reader without RF/SPI delays")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    results = []
+    for scenario in args.scenarios.split(","):
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario!r}")
+        for processes in (int(n) for n in args.processes.split(",")):
+            result = run_scenario(args.db, scenario, processes, args.bottles, not args.no_latency)
+            logger.info("%s x%d: %.1f bottles/min, p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, %d lock retries",
+                        scenario, processes, result["bottles_per_minute"], result["p50_ms"],
+                        result["p95_ms"], result["p99_ms"], result["db_lock_retries"])
+            results.append(result)
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "bottles_per_process": args.bottles,
+        "latency": not args.no_latency,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            logger.error("Regression: %s", regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
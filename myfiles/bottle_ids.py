@@ -0,0 +1,125 @@
+# Flaschen_ID allocation for one or more tagging stations. IDs are reserved in
+# blocks from a sequence table inside one BEGIN IMMEDIATE transaction and then
+# handed out from memory, so parallel stations never get the same ID. The tables
+# are created by db_migrations (migration 3).
+from datetime import datetime
+import logging
+import os
+import socket
+import threading
+import metrics
+
+logger = logging.getLogger("bottle_ids")
+
+ALLOCATE_LATENCY = metrics.histogram("bottle_id_allocate_seconds", "Duration of next_id calls")
+RESERVE_LATENCY = metrics.histogram("bottle_id_reserve_block_seconds", "Duration of reserving a Flaschen_ID block")
+
+SEQUENCE_NAME = "Flasche"
+DEFAULT_BLOCK_SIZE = 100
+
+
+
+def owner_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def gaps(conn):
+    """(first, last) ranges of reserved IDs that were never used, oldest first."""
+    rows = conn.execute("""
+        SELECT Last_Used + 1, Block_End
+        FROM Flaschen_ID_Block
+        WHERE Closed_At IS NOT NULL AND Last_Used < Block_End
+        ORDER BY Block_Start
+    """)
+    return [(first, last) for first, last in rows]
+
+
+class BottleIdAllocator:
+    """Hands out Flaschen_IDs; `db` is the database.Database whose writer reserves the blocks."""
+
+    def __init__(self, db, block_size=DEFAULT_BLOCK_SIZE, owner=None):
+        self.block_size = block_size
+        self.owner = owner or owner_name()
+        self._db = db
+        self._lock = threading.Lock()
+        self._next = None
+        self._block = None  # (start, end) of the block currently handed out
+        self.recover_crashed_blocks()
+
+    @metrics.timed(RESERVE_LATENCY)
+    def _reserve_block(self):
+        with self._db.transaction() as conn:
+            row = conn.execute("SELECT Next_ID FROM Sequenz WHERE Name = ?", (SEQUENCE_NAME,)).fetchone()
+            highest = conn.execute("SELECT MAX(Flaschen_ID) FROM Flasche").fetchone()[0]
+            # Never hand out an ID that is already in Flasche, even if it was inserted without us
+            start = max(row[0] if row else 1, (highest or 0) + 1)
+            end = start + self.block_size - 1
+            conn.execute("""
+                INSERT INTO Sequenz (Name, Next_ID) VALUES (?, ?)
+                ON CONFLICT(Name) DO UPDATE SET Next_ID = excluded.Next_ID
+            """, (SEQUENCE_NAME, end + 1))
+            conn.execute("""
+                INSERT INTO Flaschen_ID_Block (Block_Start, Block_End, Owner, Reserved_At)
+                VALUES (?, ?, ?, ?)
+            """, (start, end, self.owner, datetime.now()))
+        logger.info("Reserved Flaschen_IDs %d-%d for %s", start, end, self.owner)
+        return start, end
+
+    @metrics.timed(ALLOCATE_LATENCY)
+    def next_id(self):
+        with self._lock:
+            if self._block is None or self._next > self._block[1]:
+                if self._block is not None:
+                    self._close_block(self._block[1])
+                self._block = self._reserve_block()
+                self._next = self._block[0]
+            flaschen_id = self._next
+            self._next += 1
+            return flaschen_id
+
+    def _close_block(self, last_used, crashed=False, block_start=None):
+        block_start = self._block[0] if block_start is None else block_start
+        with self._db.transaction() as conn:
+            conn.execute("""
+                UPDATE Flaschen_ID_Block SET Closed_At = ?, Last_Used = ?, Crashed = ?
+                WHERE Block_Start = ?
+            """, (datetime.now(), last_used, crashed, block_start))
+
+    def recover_crashed_blocks(self):
+        """
+        Close the blocks of processes on this host that died without releasing
+        them. The last used ID is taken from Flasche; the rest becomes a gap.
+        """
+        host = socket.gethostname()
+        with self._db.reading() as conn:
+            rows = conn.execute("""
+                SELECT Block_Start, Block_End, Owner FROM Flaschen_ID_Block WHERE Closed_At IS NULL
+            """).fetchall()
+        for start, end, owner in rows:
+            owner_host, _, pid = owner.rpartition(":")
+            if owner == self.owner or owner_host != host or _pid_alive(int(pid)):
+                continue
+            with self._db.reading() as conn:
+                last_used = conn.execute(
+                    "SELECT MAX(Flaschen_ID) FROM Flasche WHERE Flaschen_ID BETWEEN ? AND ?", (start, end)
+                ).fetchone()[0]
+            last_used = start - 1 if last_used is None else last_used
+            self._close_block(last_used, crashed=True, block_start=start)
+            logger.warning("Recovered block %d-%d of crashed %s, unused IDs %d-%d",
+                           start, end, owner, last_used + 1, end)
+
+    def close(self):
+        with self._lock:
+            if self._block is not None:
+                self._close_block(self._next - 1)
+                self._block = None
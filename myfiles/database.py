@@ -0,0 +1,380 @@
+# Shared access to flaschen_database.db for the stations: a bounded pool of
+# read-only connections and one writer connection, all opened with the same
+# pragmas, busy timeout and statement cache. Stations call the typed methods
+# below instead of writing SQL; with WAL the readers never wait for the writer.
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+import db_migrations
+import fill_level
+import metrics
+import recipe_cache
+from recipe_cache import RecipeCatalog
+
+logger = logging.getLogger("database")
+
+POOL_WAIT = metrics.histogram("db_pool_wait_seconds", "Time spent waiting for a free read connection")
+
+DEFAULT_DB_PATH = db_migrations.DEFAULT_DB_PATH
+BUSY_TIMEOUT = db_migrations.BUSY_TIMEOUT
+POOL_SIZE = 4
+POOL_TIMEOUT = 10.0
+# Statements prepared per connection. The stations use about 15 different ones,
+# the default of 128 would only cost memory on the board.
+CACHED_STATEMENTS = 32
+# Rows per query of flaschen_chunks(); each chunk holds a read connection only while it is fetched
+CHUNK_SIZE = 500
+# Applied to every connection. journal_mode=WAL is persistent and set by db_migrations.
+PRAGMAS = (
+    # With WAL, NORMAL only syncs at checkpoints and stays crash-safe
+    ("synchronous", "NORMAL"),
+    # KiB when negative: 2 MiB page cache per connection
+    ("cache_size", -2048),
+    ("temp_store", "MEMORY"),
+    ("mmap_size", 16 * 1024 * 1024),
+)
+
+INSERT_FLASCHE = """
+    INSERT INTO Flasche (Flaschen_ID, Rezept_ID, Tagged_Date, has_error)
+    VALUES (?, ?, ?, ?)
+"""
+
+Flasche = namedtuple("Flasche", ["flaschen_id", "rezept_id", "tagged_date", "has_error"])
+FillLevel = namedtuple("FillLevel", ["dispenser_id", "fill_level", "time"])
+# Flasche joined with Rezept; tagged_date as stored, for exports
+FlascheRezept = namedtuple("FlascheRezept", Flasche._fields + ("stueckzahl",))
+# Bottles selected by a bulk flagging call / of those, bottles whose has_error actually changed
+FlagResult = namedtuple("FlagResult", ["matched", "changed"])
+
+# Flaschen_IDs of one bulk flagging call, joined against Flasche
+_SELECTION_TABLE = """
+    CREATE TEMP TABLE IF NOT EXISTS Flaschen_Auswahl (
+        Flaschen_ID INTEGER PRIMARY KEY
+    )
+"""
+
+
+class PoolExhausted(sqlite3.OperationalError):
+    pass
+
+
+def _parse_time(value):
+    # Tagged_Date and Time hold ISO text; old rows may hold 0 or NULL, those are kept as they are
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _flasche(row):
+    flaschen_id, rezept_id, tagged_date, has_error = row
+    return Flasche(flaschen_id, rezept_id, _parse_time(tagged_date), bool(has_error))
+
+
+def _flasche_filter(rezept_id=None, since=None, until=None):
+    # WHERE clause and parameters; recipe and time window are both covered by idx_flasche_rezept
+    conditions, params = [], []
+    if rezept_id is not None:
+        conditions.append("Rezept_ID = ?")
+        params.append(rezept_id)
+    if since is not None:
+        conditions.append("Tagged_Date >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append("Tagged_Date < ?")
+        params.append(until)
+    return (f"WHERE {' AND '.join(conditions)}" if conditions else ""), params
+
+
+def connect(db_path=DEFAULT_DB_PATH, readonly=False, cached_statements=CACHED_STATEMENTS):
+    """A connection with the station pragmas, usable from any thread (one at a time)."""
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                           cached_statements=cached_statements)
+    for name, value in PRAGMAS:
+        conn.execute(f"PRAGMA {name} = {value}")
+    if readonly:
+        conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+class Database:
+    """
+    Reads take a connection from a pool of at most `pool_size`, opened on first
+    use and reused most-recently-used first; a reader that finds all of them busy
+    waits up to `pool_timeout` seconds and then raises PoolExhausted. All writes
+    of the process go through one connection, one thread at a time. Safe to share
+    between threads; create one per process and close() it at the end.
+    """
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, pool_size=POOL_SIZE, pool_timeout=POOL_TIMEOUT,
+                 cached_statements=CACHED_STATEMENTS, migrate=True):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.cached_statements = cached_statements
+        if migrate:
+            db_migrations.ensure_schema(db_path)
+        self._closed = False
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._idle = queue.LifoQueue()
+        self._write_lock = threading.RLock()
+        self._writer = None
+        self._catalog_lock = threading.Lock()
+        self._catalog = None
+
+    def connect(self, readonly=False):
+        return connect(self.db_path, readonly, self.cached_statements)
+
+    # Connections
+
+    @contextmanager
+    def reading(self):
+        """A read-only connection from the pool for the duration of the block."""
+        if self._closed:
+            raise sqlite3.ProgrammingError("Database is closed")
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.pool_timeout):
+            raise PoolExhausted(f"No read connection free after {self.pool_timeout} s")
+        if metrics.is_enabled():
+            POOL_WAIT.observe(time.perf_counter() - start)
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect(readonly=True)
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                if self._closed:
+                    conn.close()
+                else:
+                    self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def writer(self):
+        """
+        The writer connection, no other thread writes while the block runs. For
+        code that handles its transactions itself; otherwise use transaction().
+        """
+        with self._write_lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Database is closed")
+            if self._writer is None:
+                self._writer = self.connect()
+            yield self._writer
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE on the writer connection; COMMIT at the end of the block, ROLLBACK on an exception."""
+        with self.writer() as conn:
+            if conn.in_transaction:
+                # Nested in another transaction() of this thread, that one commits
+                yield conn
+                return
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+
+    @property
+    def catalog(self):
+        """The recipe tables in memory (RecipeCatalog), on a connection of its own."""
+        with self._catalog_lock:
+            if self._catalog is None:
+                self._catalog = RecipeCatalog(self.connect(readonly=True))
+            return self._catalog
+
+    def close(self):
+        self._closed = True
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._catalog_lock:
+            if self._catalog is not None:
+                self._catalog.close()
+                self._catalog = None
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+    # Flasche
+
+    def flasche(self, flaschen_id):
+        """The Flasche row of a bottle, None if there is none."""
+        with self.reading() as conn:
+            row = conn.execute("""
+                SELECT Flaschen_ID, Rezept_ID, Tagged_Date, has_error FROM Flasche WHERE Flaschen_ID = ?
+            """, (flaschen_id,)).fetchone()
+        return None if row is None else _flasche(row)
+
+    def rezept_id(self, flaschen_id):
+        """Rezept_ID of a bottle, None if the bottle is unknown or has no recipe."""
+        with self.reading() as conn:
+            row = conn.execute("SELECT Rezept_ID FROM Flasche WHERE Flaschen_ID = ?", (flaschen_id,)).fetchone()
+        return None if row is None or row[0] is None else int(row[0])
+
+    def max_flaschen_id(self):
+        with self.reading() as conn:
+            return conn.execute("SELECT MAX(Flaschen_ID) FROM Flasche").fetchone()[0]
+
+    def flaschen(self, since=None, until=None):
+        """Bottles tagged in [since, until), all bottles without bounds, ordered by Flaschen_ID."""
+        where, params = _flasche_filter(since=since, until=until)
+        with self.reading() as conn:
+            rows = conn.execute(f"""
+                SELECT Flaschen_ID, Rezept_ID, Tagged_Date, has_error FROM Flasche {where}
+                ORDER BY Flaschen_ID
+            """, params).fetchall()
+        return [_flasche(row) for row in rows]
+
+    def flaschen_chunks(self, after=None, chunk_size=CHUNK_SIZE):
+        """
+        Bottles with a Flaschen_ID above `after` (all without) as lists of up to
+        `chunk_size` FlascheRezept, in Flaschen_ID order. Every chunk is its own
+        query continuing after the last Flaschen_ID of the previous one, so no
+        read snapshot is held between chunks and bottles tagged meanwhile are
+        picked up at the end.
+        """
+        last = -1 if after is None else after
+        while True:
+            with self.reading() as conn:
+                chunk = conn.execute("""
+                    SELECT f.Flaschen_ID, f.Rezept_ID, f.Tagged_Date, f.has_error, r.Stueckzahl
+                    FROM Flasche f LEFT JOIN Rezept r ON r.Rezept_ID = f.Rezept_ID
+                    WHERE f.Flaschen_ID > ?
+                    ORDER BY f.Flaschen_ID
+                    LIMIT ?
+                """, (last, chunk_size)).fetchmany(chunk_size)
+            if not chunk:
+                return
+            yield [
+                FlascheRezept(flaschen_id, rezept_id, tagged_date, bool(has_error), stueckzahl)
+                for flaschen_id, rezept_id, tagged_date, has_error, stueckzahl in chunk
+            ]
+            last = chunk[-1][0]
+            if len(chunk) < chunk_size:
+                return
+
+    def flaschen_with_error(self):
+        with self.reading() as conn:
+            rows = conn.execute("""
+                SELECT Flaschen_ID, Rezept_ID, Tagged_Date, has_error FROM Flasche WHERE has_error = 1
+                ORDER BY Flaschen_ID
+            """).fetchall()
+        return [_flasche(row) for row in rows]
+
+    def error_counts(self, since=None):
+        """{Rezept_ID: bottles with has_error} tagged since `since`, from the partial idx_flasche_error."""
+        where, params = _flasche_filter(since=since)
+        where = f"{where} AND has_error = 1" if where else "WHERE has_error = 1"
+        with self.reading() as conn:
+            return dict(conn.execute(f"SELECT Rezept_ID, COUNT(*) FROM Flasche {where} GROUP BY Rezept_ID", params))
+
+    def insert_flaschen(self, rows):
+        """Insert (Flaschen_ID, Rezept_ID, Tagged_Date, has_error) rows in one transaction."""
+        with self.transaction() as conn:
+            conn.executemany(INSERT_FLASCHE, rows)
+
+    def set_has_error(self, flaschen_id, has_error=True):
+        """True if the bottle exists."""
+        with self.transaction() as conn:
+            return conn.execute(
+                "UPDATE Flasche SET has_error = ? WHERE Flaschen_ID = ?", (bool(has_error), flaschen_id)
+            ).rowcount == 1
+
+    def set_has_error_many(self, flaschen_ids, has_error=True):
+        """
+        Flag every bottle in `flaschen_ids` in one transaction. The IDs go into a
+        temporary table first, so the update is one join however many there are.
+        Unknown IDs are skipped. Returns a FlagResult.
+        """
+        with self.transaction() as conn:
+            conn.execute(_SELECTION_TABLE)
+            conn.execute("DELETE FROM temp.Flaschen_Auswahl")
+            conn.executemany(
+                "INSERT OR IGNORE INTO temp.Flaschen_Auswahl (Flaschen_ID) VALUES (?)",
+                ((flaschen_id,) for flaschen_id in flaschen_ids))
+            selection = "Flaschen_ID IN (SELECT Flaschen_ID FROM temp.Flaschen_Auswahl)"
+            matched = conn.execute(f"SELECT COUNT(*) FROM Flasche WHERE {selection}").fetchone()[0]
+            # Rows that already have the flag are not rewritten
+            changed = conn.execute(
+                f"UPDATE Flasche SET has_error = ? WHERE {selection} AND has_error IS NOT ?",
+                (bool(has_error), bool(has_error))).rowcount
+            conn.execute("DELETE FROM temp.Flaschen_Auswahl")
+        logger.info("has_error=%s: %d of %d bottles changed", bool(has_error), changed, matched)
+        return FlagResult(matched, changed)
+
+    def set_has_error_where(self, rezept_id=None, since=None, until=None, has_error=True):
+        """
+        Flag the bottles of a recipe and/or tagged in [since, until) in one
+        transaction, e.g. a batch rejected by QC. Returns a FlagResult.
+        """
+        where, params = _flasche_filter(rezept_id, since, until)
+        if not where:
+            raise ValueError("No condition given, use rezept_id, since or until")
+        with self.transaction() as conn:
+            matched = conn.execute(f"SELECT COUNT(*) FROM Flasche {where}", params).fetchone()[0]
+            changed = conn.execute(
+                f"UPDATE Flasche SET has_error = ? {where} AND has_error IS NOT ?",
+                [bool(has_error)] + params + [bool(has_error)]).rowcount
+        logger.info("has_error=%s: %d of %d bottles changed", bool(has_error), changed, matched)
+        return FlagResult(matched, changed)
+
+    # Rezept and Rezept_besteht_aus_Granulat, served from the catalog
+
+    def mengen(self, rezept_id):
+        """Dosing list of a recipe: tuple of (Granulat_ID, Menge) sorted by Granulat_ID."""
+        return self.catalog.mengen(rezept_id)
+
+    def stueckzahl(self, rezept_id):
+        return self.catalog.stueckzahl(rezept_id)
+
+    def rezept_ids(self):
+        """Rezept_IDs that have a dosing list."""
+        return self.catalog.rezept_ids()
+
+    @metrics.timed(recipe_cache.LOOKUP_LATENCY)
+    def lookup(self, flaschen_id):
+        """Rezept_ID and dosing list of a bottle, (None, ()) if it is unknown."""
+        rezept_id = self.rezept_id(flaschen_id)
+        if rezept_id is None:
+            return None, ()
+        return rezept_id, self.mengen(rezept_id)
+
+    # Fill_Level
+
+    def latest_fill_level(self, dispenser_id):
+        with self.reading() as conn:
+            row = conn.execute("""
+                SELECT Dispenser_ID, Fill_Level, Time FROM Fill_Level
+                WHERE Dispenser_ID = ? ORDER BY Time DESC LIMIT 1
+            """, (dispenser_id,)).fetchone()
+        return None if row is None else FillLevel(row[0], row[1], _parse_time(row[2]))
+
+    def fill_level_series(self, dispenser_id, since, granularity="hour"):
+        """Rollup rows (bucket, samples, average, min, max, last), see fill_level.series()."""
+        with self.reading() as conn:
+            return fill_level.series(conn, dispenser_id, since, granularity)
+
+    def ingest_fill_levels(self, samples):
+        """Store (Dispenser_ID, Fill_Level, Time) samples, see fill_level.ingest()."""
+        with self.transaction() as conn:
+            return fill_level.ingest(conn, samples)
@@ -0,0 +1,224 @@
+# Versioned schema migrations for flaschen_database.db, keyed on PRAGMA user_version.
+# Usage: python db_migrations.py [path/to/db] [--check]
+import logging
+import re
+import sqlite3
+import sys
+
+logger = logging.getLogger("db_migrations")
+
+DEFAULT_DB_PATH = "../data/flaschen_database.db"
+BUSY_TIMEOUT = 30.0
+
+# (version, description, statements). Append only; never change a released migration.
+MIGRATIONS = [
+    (1, "indexes for station 2 and the Flasche reports", (
+        # Station 2 reads the dosing list of a recipe for every bottle
+        """CREATE INDEX IF NOT EXISTS idx_rezept_granulat
+           ON Rezept_besteht_aus_Granulat (Rezept_ID, Granulat_ID, Menge)""",
+        """CREATE INDEX IF NOT EXISTS idx_flasche_rezept
+           ON Flasche (Rezept_ID, Tagged_Date)""",
+        """CREATE INDEX IF NOT EXISTS idx_flasche_tagged
+           ON Flasche (Tagged_Date, Rezept_ID)""",
+        # Only a few bottles have errors, the partial index stays tiny
+        """CREATE INDEX IF NOT EXISTS idx_flasche_error
+           ON Flasche (Tagged_Date, Rezept_ID) WHERE has_error = 1""",
+    )),
+    (2, "Fill_Level rollups per minute and hour", (
+        """CREATE TABLE IF NOT EXISTS Fill_Level_Minute (
+               Dispenser_ID INTEGER,
+               Minute TEXT,
+               Samples INTEGER NOT NULL,
+               Sum_Level INTEGER NOT NULL,
+               Min_Level INTEGER NOT NULL,
+               Max_Level INTEGER NOT NULL,
+               Last_Level INTEGER NOT NULL,
+               Last_Time TIMESTAMP NOT NULL,
+               PRIMARY KEY (Dispenser_ID, Minute)
+           ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS Fill_Level_Hour (
+               Dispenser_ID INTEGER,
+               Hour TEXT,
+               Samples INTEGER NOT NULL,
+               Sum_Level INTEGER NOT NULL,
+               Min_Level INTEGER NOT NULL,
+               Max_Level INTEGER NOT NULL,
+               Last_Level INTEGER NOT NULL,
+               Last_Time TIMESTAMP NOT NULL,
+               PRIMARY KEY (Dispenser_ID, Hour)
+           ) WITHOUT ROWID""",
+        # Backfill from the samples that are already there
+        """INSERT OR IGNORE INTO Fill_Level_Minute
+           SELECT Dispenser_ID, substr(Time, 1, 16), COUNT(*), SUM(Fill_Level), MIN(Fill_Level),
+                  MAX(Fill_Level), MAX(CASE WHEN Latest = 1 THEN Fill_Level END), MAX(Time)
+           FROM (SELECT *, row_number() OVER (
+                     PARTITION BY Dispenser_ID, substr(Time, 1, 16) ORDER BY Time DESC) AS Latest
+                 FROM Fill_Level)
+           GROUP BY Dispenser_ID, substr(Time, 1, 16)""",
+        """INSERT OR IGNORE INTO Fill_Level_Hour
+           SELECT Dispenser_ID, substr(Time, 1, 13), COUNT(*), SUM(Fill_Level), MIN(Fill_Level),
+                  MAX(Fill_Level), MAX(CASE WHEN Latest = 1 THEN Fill_Level END), MAX(Time)
+           FROM (SELECT *, row_number() OVER (
+                     PARTITION BY Dispenser_ID, substr(Time, 1, 13) ORDER BY Time DESC) AS Latest
+                 FROM Fill_Level)
+           GROUP BY Dispenser_ID, substr(Time, 1, 13)""",
+    )),
+    # 3 and 4 were created on the fly by bottle_ids and recipe_cache before,
+    # IF NOT EXISTS keeps them working on databases that already have them
+    (3, "Flaschen_ID sequence and reserved ID blocks", (
+        """CREATE TABLE IF NOT EXISTS Sequenz (
+               Name TEXT PRIMARY KEY,
+               Next_ID INTEGER NOT NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS Flaschen_ID_Block (
+               Block_Start INTEGER PRIMARY KEY,
+               Block_End INTEGER NOT NULL,
+               Owner TEXT NOT NULL,
+               Reserved_At TIMESTAMP NOT NULL,
+               Closed_At TIMESTAMP,
+               Last_Used INTEGER,
+               Crashed BOOLEAN NOT NULL DEFAULT 0
+           )""",
+    )),
+    (4, "change counter of the recipe tables for the station 2 cache", (
+        """CREATE TABLE IF NOT EXISTS Katalog_Version (
+               Id INTEGER PRIMARY KEY CHECK (Id = 1),
+               Version INTEGER NOT NULL
+           )""",
+        "INSERT OR IGNORE INTO Katalog_Version (Id, Version) VALUES (1, 0)",
+    ) + tuple(
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_{event}_katalog AFTER {event} ON {table}
+            BEGIN
+                UPDATE Katalog_Version SET Version = Version + 1 WHERE Id = 1;
+            END"""
+        for table in ("Rezept", "Rezept_besteht_aus_Granulat")
+        for event in ("INSERT", "UPDATE", "DELETE")
+    )),
+]
+
+# Queries that run per bottle or per dashboard refresh. None of them may scan a whole table.
+HOT_PATH_QUERIES = {
+    "flasche_by_id": ("SELECT Rezept_ID FROM Flasche WHERE Flaschen_ID = ?", (1,)),
+    "max_flaschen_id": ("SELECT MAX(Flaschen_ID) FROM Flasche", ()),
+    "granulat_by_rezept": ("""
+        SELECT Granulat_ID, Menge FROM Rezept_besteht_aus_Granulat
+        WHERE Rezept_ID = ? ORDER BY Granulat_ID
+    """, (1,)),
+    "flaschen_by_rezept": ("SELECT COUNT(*) FROM Flasche WHERE Rezept_ID = ?", (1,)),
+    "flaschen_by_date": ("""
+        SELECT Flaschen_ID, Rezept_ID FROM Flasche
+        WHERE Tagged_Date >= ? AND Tagged_Date < ?
+    """, ("2024-01-01", "2024-01-02")),
+    "flaschen_with_error": ("""
+        SELECT Flaschen_ID, Rezept_ID, Tagged_Date FROM Flasche WHERE has_error = 1
+    """, ()),
+    "error_counts_by_rezept": ("""
+        SELECT Rezept_ID, COUNT(*) FROM Flasche
+        WHERE Tagged_Date >= ? AND has_error = 1 GROUP BY Rezept_ID
+    """, ("2024-01-01",)),
+    "flaschen_by_rezept_and_date": ("""
+        SELECT COUNT(*) FROM Flasche
+        WHERE Rezept_ID = ? AND Tagged_Date >= ? AND Tagged_Date < ?
+    """, (1, "2024-01-01", "2024-01-02")),
+    "fill_level_latest": ("""
+        SELECT Fill_Level, Time FROM Fill_Level
+        WHERE Dispenser_ID = ? ORDER BY Time DESC LIMIT 1
+    """, (1,)),
+    "fill_level_hours": ("""
+        SELECT Hour, Samples, Sum_Level, Min_Level, Max_Level, Last_Level FROM Fill_Level_Hour
+        WHERE Dispenser_ID = ? AND Hour >= ? ORDER BY Hour
+    """, (1, "2024-01-01 00")),
+}
+
+
+class QueryPlanError(RuntimeError):
+    pass
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Apply all migrations newer than the database. Returns the list of applied versions."""
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version <= schema_version(conn):
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Re-check under the write lock, another station may have migrated meanwhile
+            if version <= schema_version(conn):
+                conn.execute("ROLLBACK")
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            logger.exception("Migration %d (%s) failed", version, description)
+            raise
+        logger.info("Applied migration %d: %s", version, description)
+        applied.append(version)
+
+    if applied:
+        conn.execute("ANALYZE")
+    return applied
+
+
+def _partial_indexes(conn):
+    names = set()
+    for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"):
+        for row in conn.execute(f"PRAGMA index_list('{table}')"):
+            if row[4]:
+                names.add(row[1])
+    return names
+
+
+def check_query_plans(conn, queries=HOT_PATH_QUERIES):
+    """
+    Raise QueryPlanError if any hot-path query plan scans a whole table. Scanning
+    a whole index counts as a table scan too, unless it is a partial index.
+    """
+    partial = _partial_indexes(conn)
+    problems = []
+    for name, (sql, params) in queries.items():
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row[-1]
+            if not detail.startswith("SCAN "):
+                continue
+            match = re.search(r"USING (?:COVERING )?INDEX (\w+)", detail)
+            if match is None or match.group(1) not in partial:
+                problems.append(f"{name}: {detail}")
+    if problems:
+        raise QueryPlanError("Full table scan in hot-path queries: " + "; ".join(problems))
+
+
+def ensure_schema(db_path=DEFAULT_DB_PATH):
+    """Migrate the database and switch it to WAL. Called by the stations at startup."""
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    try:
+        migrate(conn)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return schema_version(conn)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    db_path = args[0] if args else DEFAULT_DB_PATH
+    version = ensure_schema(db_path)
+    logger.info("%s is at schema version %d", db_path, version)
+    if "--check" in sys.argv[1:]:
+        conn = sqlite3.connect(db_path)
+        try:
+            check_query_plans(conn)
+        except QueryPlanError as e:
+            logger.error("%s", e)
+            sys.exit(1)
+        finally:
+            conn.close()
+        logger.info("All hot-path queries use an index")
@@ -0,0 +1,180 @@
+# Write-behind persistence: rows are queued by the station loop and written by a
+# background thread in batched transactions, so the RFID loop never waits for an fsync.
+import atexit
+from collections import deque
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import metrics
+from database import INSERT_FLASCHE
+
+logger = logging.getLogger("db_writer")
+
+BATCH_LATENCY = metrics.histogram("db_write_batch_seconds", "Duration of writing one batch including the commit")
+ROWS_WRITTEN = metrics.counter("db_rows_written_total", "Rows committed by the write-behind writer")
+WRITE_ERRORS = metrics.counter("db_write_errors_total", "Failed batch or row writes", label="reason")
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_FLUSH_INTERVAL = 1.0
+RETRY_DELAY = 0.5
+# Once close() was called, a batch waiting for a locked database is given up after this many seconds
+CLOSE_RETRY_TIMEOUT = 10.0
+# Rows that could not be written are kept here (the oldest go first) for the operator to resubmit
+MAX_PARKED = 1000
+_BUSY_ERRORS = ("SQLITE_BUSY", "SQLITE_LOCKED")
+_STOP = object()
+
+
+def is_busy(error):
+    """True if `error` only means another connection holds the lock, i.e. retrying helps."""
+    name = getattr(error, "sqlite_errorname", None)
+    if name is None:
+        # Before Python 3.11 only the message tells
+        return str(error).startswith(("database is locked", "database table is locked"))
+    return name in _BUSY_ERRORS or name.startswith(tuple(code + "_" for code in _BUSY_ERRORS))
+
+
+class WriteBehindWriter:
+    """
+    Writes from a background thread through the writer connection of `db` (a
+    database.Database). submit() only enqueues; rows are written with executemany
+    once `batch_size` rows are waiting or the oldest one has waited
+    `flush_interval` seconds. close() (also run at exit) writes everything that
+    was submitted before returning; close it before the Database.
+    While the database is locked a batch is retried (for at most
+    CLOSE_RETRY_TIMEOUT seconds once closing); rows that fail for any other
+    reason are logged, counted and kept in `parked` instead of blocking the queue.
+    """
+
+    def __init__(self, db, sql=INSERT_FLASCHE, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, max_queue=0):
+        self.db = db
+        self.sql = sql
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self.batches = 0
+        self.failures = 0
+        self.max_depth = 0
+        self.last_batch_seconds = 0.0
+        self.parked = deque(maxlen=MAX_PARKED)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._close_deadline = None
+        self._thread = threading.Thread(target=self._run, name="db_writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, params):
+        if self._closed:
+            raise RuntimeError("Writer is closed")
+        self._queue.put(params)
+        depth = self._queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def flush(self):
+        """Block until every row submitted so far is written."""
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._close_deadline = time.monotonic() + CLOSE_RETRY_TIMEOUT
+        self._queue.put(_STOP)
+        self._thread.join()
+        atexit.unregister(self.close)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def metrics(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_depth,
+            "rows_written": self.rows_written,
+            "batches": self.batches,
+            "failures": self.failures,
+            "parked": len(self.parked),
+            "last_batch_ms": round(self.last_batch_seconds * 1000, 2),
+        }
+
+    # Writer thread
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        start = time.perf_counter()
+        while True:
+            try:
+                with self.db.transaction() as conn:
+                    conn.executemany(self.sql, batch)
+                self.rows_written += len(batch)
+                ROWS_WRITTEN.inc(amount=len(batch))
+                break
+            except sqlite3.IntegrityError as e:
+                WRITE_ERRORS.inc("integrity")
+                logger.error("Batch of %d rows rejected (%s), writing rows one by one", len(batch), e)
+                self._write_rows(batch)
+                break
+            except Exception as e:
+                if not (isinstance(e, sqlite3.OperationalError) and is_busy(e)):
+                    # Disk full, read-only or broken database: retrying would block the queue for good
+                    self._park(batch, "failed", e)
+                    break
+                if self._close_deadline is not None and time.monotonic() >= self._close_deadline:
+                    self._park(batch, "locked_at_close", e)
+                    break
+                # The rows stay queued in memory until the lock is free
+                self.failures += 1
+                WRITE_ERRORS.inc("locked")
+                logger.warning("Writing batch of %d rows failed (%s), retrying", len(batch), e)
+                time.sleep(RETRY_DELAY)
+        self.last_batch_seconds = time.perf_counter() - start
+        if metrics.is_enabled():
+            BATCH_LATENCY.observe(self.last_batch_seconds)
+        self.batches += 1
+        logger.debug("Wrote %d rows in %.1f ms", len(batch), self.last_batch_seconds * 1000)
+
+    def _park(self, batch, reason, error):
+        self.failures += 1
+        WRITE_ERRORS.inc(reason, amount=len(batch))
+        self.parked.extend(batch)
+        logger.error("Writing batch of %d rows failed (%s), rows kept in parked: %r", len(batch), error, batch)
+
+    def _write_rows(self, batch):
+        for params in batch:
+            try:
+                with self.db.transaction() as conn:
+                    conn.execute(self.sql, params)
+                self.rows_written += 1
+                ROWS_WRITTEN.inc()
+            except sqlite3.Error as e:
+                self.failures += 1
+                WRITE_ERRORS.inc("dropped")
+                logger.error("Dropping row %r: %s", params, e)
@@ -0,0 +1,127 @@
+# Export of the bottle history (Flasche with its recipe) as CSV or JSON Lines.
+# Rows are streamed chunk by chunk from database.Database.flaschen_chunks(), so
+# memory stays constant however many bottles were tagged. The resume token is
+# the last exported Flaschen_ID: pass it back as `after` to export only the
+# bottles tagged since, e.g. from a nightly cron job:
+#
+#   python export.py --format jsonl --output flaschen.jsonl --append --state export.token
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+
+import database
+
+logger = logging.getLogger("export")
+
+FORMATS = ("csv", "jsonl")
+FIELDS = ("flaschen_id", "rezept_id", "tagged_date", "has_error", "stueckzahl", "mengen")
+
+
+def _record(db, flasche):
+    record = flasche._asdict()
+    # [[Granulat_ID, Menge], ...], the dosing lists come from the in-memory catalog
+    record["mengen"] = [] if flasche.rezept_id is None else [list(entry) for entry in db.mengen(flasche.rezept_id)]
+    return record
+
+
+class CsvWriter:
+    def __init__(self, out, header=True):
+        self._writer = csv.writer(out)
+        if header:
+            self._writer.writerow(FIELDS)
+
+    def write(self, record):
+        record["has_error"] = int(record["has_error"])
+        record["mengen"] = json.dumps(record["mengen"], separators=(",", ":"))
+        self._writer.writerow(record[field] for field in FIELDS)
+
+
+class JsonLinesWriter:
+    def __init__(self, out, header=True):
+        self._out = out
+
+    def write(self, record):
+        self._out.write(json.dumps(record, default=str, separators=(",", ":")))
+        self._out.write("\n")
+
+
+WRITERS = {"csv": CsvWriter, "jsonl": JsonLinesWriter}
+
+
+def export(db, out, fmt="csv", after=None, chunk_size=database.CHUNK_SIZE, header=True):
+    """
+    Write the bottles with a Flaschen_ID above `after` to the text stream `out`.
+    Returns (rows written, resume token); the token is `after` if nothing was new.
+    """
+    writer = WRITERS[fmt](out, header)
+    count = 0
+    token = after
+    for chunk in db.flaschen_chunks(after, chunk_size):
+        for flasche in chunk:
+            writer.write(_record(db, flasche))
+        count += len(chunk)
+        token = chunk[-1].flaschen_id
+        out.flush()
+    return count, token
+
+
+def read_token(path):
+    """The Flaschen_ID stored in a state file, None if there is none yet."""
+    try:
+        with open(path) as f:
+            text = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return int(text) if text else None
+
+
+def write_token(path, token):
+    # Replaced in one step, a crash never leaves a half written token
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(f"{token}\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the bottle history")
+    parser.add_argument("--db", default=database.DEFAULT_DB_PATH)
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--output", help="file to write, stdout without")
+    parser.add_argument("--append", action="store_true", help="append to --output instead of replacing it")
+    parser.add_argument("--after", type=int, help="only bottles with a higher Flaschen_ID")
+    parser.add_argument("--state", help="file with the resume token, read before and updated after the export")
+    parser.add_argument("--chunk-size", type=int, default=database.CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    after = args.after
+    if after is None and args.state:
+        after = read_token(args.state)
+    db = database.Database(args.db)
+    try:
+        if args.output is None:
+            count, token = export(db, sys.stdout, args.format, after, args.chunk_size)
+        else:
+            mode = "a" if args.append else "w"
+            with open(args.output, mode, newline="" if args.format == "csv" else None) as out:
+                # A CSV file that is appended to keeps its first header
+                header = out.tell() == 0
+                count, token = export(db, out, args.format, after, args.chunk_size, header)
+                out.flush()
+                os.fsync(out.fileno())
+    finally:
+        db.close()
+    # Only once the rows are on disk, a failed export is repeated from the old token
+    if args.state and token is not None:
+        write_token(args.state, token)
+    logger.info("Exported %d bottles after Flaschen_ID %s, resume token %s", count, after, token)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    main()
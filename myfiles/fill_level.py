@@ -0,0 +1,166 @@
+# Fill_Level telemetry: batched ingestion of dispenser samples, incremental
+# per-minute/per-hour rollups and chunked retention of the raw samples.
+# The rollup tables are created by db_migrations (migration 2).
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import logging
+import time
+
+logger = logging.getLogger("fill_level")
+
+RAW_RETENTION = timedelta(days=7)
+MINUTE_RETENTION = timedelta(days=90)
+PRUNE_CHUNK = 500
+PRUNE_PAUSE = 0.05
+
+# Rollup table -> (bucket column, length of the Time prefix that makes up the bucket)
+ROLLUPS = {
+    "Fill_Level_Minute": ("Minute", 16),
+    "Fill_Level_Hour": ("Hour", 13),
+}
+
+_BATCH_TABLE = """
+    CREATE TEMP TABLE IF NOT EXISTS Fill_Level_Batch (
+        Dispenser_ID INTEGER,
+        Fill_Level INTEGER,
+        Time TIMESTAMP,
+        PRIMARY KEY (Dispenser_ID, Time)
+    )
+"""
+
+_ROLLUP_UPSERT = """
+    INSERT INTO {table} (Dispenser_ID, {bucket}, Samples, Sum_Level, Min_Level, Max_Level, Last_Level, Last_Time)
+    SELECT Dispenser_ID, substr(Time, 1, {length}), COUNT(*), SUM(Fill_Level), MIN(Fill_Level),
+           MAX(Fill_Level), MAX(CASE WHEN Latest = 1 THEN Fill_Level END), MAX(Time)
+    FROM (SELECT *, row_number() OVER (
+              PARTITION BY Dispenser_ID, substr(Time, 1, {length}) ORDER BY Time DESC) AS Latest
+          FROM temp.Fill_Level_Batch)
+    GROUP BY Dispenser_ID, substr(Time, 1, {length})
+    ON CONFLICT (Dispenser_ID, {bucket}) DO UPDATE SET
+        Samples = Samples + excluded.Samples,
+        Sum_Level = Sum_Level + excluded.Sum_Level,
+        Min_Level = min(Min_Level, excluded.Min_Level),
+        Max_Level = max(Max_Level, excluded.Max_Level),
+        Last_Level = CASE WHEN excluded.Last_Time > Last_Time THEN excluded.Last_Level ELSE Last_Level END,
+        Last_Time = max(Last_Time, excluded.Last_Time)
+"""
+
+
+def _timestamp(value):
+    # Same text format as the rows already in Fill_Level, so buckets and ranges compare as strings
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ", timespec="microseconds")
+    return str(value)
+
+
+@contextmanager
+def _write_transaction(conn):
+    # BEGIN IMMEDIATE takes the write lock (waiting up to the busy timeout) before
+    # the first read; a deferred transaction that reads first and then wants to
+    # write fails with "database is locked" right away. Inside a transaction the
+    # caller opened (Database.transaction()) the statements just join it.
+    if conn.in_transaction:
+        yield
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def ingest(conn, samples):
+    """
+    Write an iterable of (Dispenser_ID, Fill_Level, Time) in one write
+    transaction and fold them into the rollups. Samples already stored (same dispenser and time)
+    are skipped and not counted twice. Returns the number of new samples.
+    """
+    rows = [(dispenser_id, level, _timestamp(ts)) for dispenser_id, level, ts in samples]
+    if not rows:
+        return 0
+    conn.execute(_BATCH_TABLE)
+    with _write_transaction(conn):
+        conn.execute("DELETE FROM temp.Fill_Level_Batch")
+        conn.executemany("INSERT OR IGNORE INTO temp.Fill_Level_Batch VALUES (?, ?, ?)", rows)
+        conn.execute("""
+            DELETE FROM temp.Fill_Level_Batch
+            WHERE EXISTS (SELECT 1 FROM Fill_Level f
+                          WHERE f.Dispenser_ID = Fill_Level_Batch.Dispenser_ID
+                            AND f.Time = Fill_Level_Batch.Time)
+        """)
+        inserted = conn.execute("""
+            INSERT INTO Fill_Level (Dispenser_ID, Fill_Level, Time)
+            SELECT Dispenser_ID, Fill_Level, Time FROM temp.Fill_Level_Batch
+        """).rowcount
+        for table, (bucket, length) in ROLLUPS.items():
+            conn.execute(_ROLLUP_UPSERT.format(table=table, bucket=bucket, length=length))
+        conn.execute("DELETE FROM temp.Fill_Level_Batch")
+    logger.debug("Ingested %d of %d fill level samples", inserted, len(rows))
+    return inserted
+
+
+def _prune(conn, select_chunk, dispenser_ids, cutoff, chunk_size, pause):
+    deleted = 0
+    for dispenser_id in dispenser_ids:
+        while True:
+            # One short transaction per chunk so station writers are never locked out for long
+            with _write_transaction(conn):
+                count = conn.execute(select_chunk, (dispenser_id, cutoff, chunk_size)).rowcount
+            deleted += count
+            if count < chunk_size:
+                break
+            time.sleep(pause)
+    return deleted
+
+
+def prune(conn, now=None, raw_retention=RAW_RETENTION, minute_retention=MINUTE_RETENTION,
+          chunk_size=PRUNE_CHUNK, pause=PRUNE_PAUSE):
+    """
+    Delete raw samples older than `raw_retention` and minute rollups older than
+    `minute_retention`, `chunk_size` rows per transaction. Hourly rollups are kept.
+    Returns (raw rows deleted, minute rows deleted).
+    """
+    now = now or datetime.now()
+    dispenser_ids = [row[0] for row in conn.execute("SELECT DISTINCT Dispenser_ID FROM Fill_Level_Hour")]
+    raw = _prune(conn, """
+        DELETE FROM Fill_Level WHERE rowid IN (
+            SELECT rowid FROM Fill_Level WHERE Dispenser_ID = ? AND Time < ? LIMIT ?)
+    """, dispenser_ids, _timestamp(now - raw_retention), chunk_size, pause)
+    minutes = _prune(conn, """
+        DELETE FROM Fill_Level_Minute WHERE (Dispenser_ID, Minute) IN (
+            SELECT Dispenser_ID, Minute FROM Fill_Level_Minute WHERE Dispenser_ID = ? AND Minute < ? LIMIT ?)
+    """, dispenser_ids, _timestamp(now - minute_retention)[:16], chunk_size, pause)
+    if raw or minutes:
+        logger.info("Pruned %d raw fill level samples and %d minute rollups", raw, minutes)
+    return raw, minutes
+
+
+def series(conn, dispenser_id, since, granularity="hour"):
+    """Rollup rows (bucket, samples, average, min, max, last) of one dispenser since `since`."""
+    table = "Fill_Level_Hour" if granularity == "hour" else "Fill_Level_Minute"
+    bucket, length = ROLLUPS[table]
+    return [
+        (start, samples, total / samples, low, high, last)
+        for start, samples, total, low, high, last in conn.execute(f"""
+            SELECT {bucket}, Samples, Sum_Level, Min_Level, Max_Level, Last_Level FROM {table}
+            WHERE Dispenser_ID = ? AND {bucket} >= ? ORDER BY {bucket}
+        """, (dispenser_id, _timestamp(since)[:length]))
+    ]
+
+
+if __name__ == "__main__":
+    # Meant to run from cron, e.g. nightly: python fill_level.py [path/to/db]
+    import sqlite3
+    import sys
+    import db_migrations
+
+    logging.basicConfig(level=logging.INFO)
+    db_path = sys.argv[1] if len(sys.argv) > 1 else db_migrations.DEFAULT_DB_PATH
+    db_migrations.ensure_schema(db_path)
+    conn = sqlite3.connect(db_path, timeout=db_migrations.BUSY_TIMEOUT)
+    try:
+        prune(conn)
+    finally:
+        conn.close()
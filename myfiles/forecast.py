@@ -0,0 +1,131 @@
+# When does each granulate dispenser run empty? Combines the hourly Fill_Level
+# rollups with the recipe quantities and the recent recipe mix of tagged bottles.
+# Everything is loaded in bulk into NumPy arrays and computed without Python row loops.
+from collections import namedtuple
+from datetime import datetime, timedelta
+import logging
+
+import numpy as np
+
+logger = logging.getLogger("forecast")
+
+HISTORY = timedelta(days=90)
+MIX_WINDOW = timedelta(days=7)
+
+# One entry per dispenser, all fields are arrays of the same length.
+# consumption_per_hour and hours_to_empty come from the fill level sensors;
+# demand_per_hour (in Menge units) comes from the recipes of recently tagged bottles.
+Forecast = namedtuple("Forecast", [
+    "dispenser_id",
+    "current_level",
+    "consumption_per_hour",
+    "hours_to_empty",
+    "demand_per_hour",
+    "hours_to_empty_by_demand",
+])
+
+
+def load_levels(conn, since):
+    """(dispenser_id, hour, level) arrays of the hourly rollups, sorted by dispenser and hour."""
+    rows = conn.execute("""
+        SELECT Dispenser_ID, (julianday(Hour || ':00') - 2440587.5) * 24.0, Last_Level
+        FROM Fill_Level_Hour
+        WHERE Hour >= ?
+        ORDER BY Dispenser_ID, Hour
+    """, (since.strftime("%Y-%m-%d %H"),)).fetchall()
+    data = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    return data[:, 0].astype(np.int64), data[:, 1], data[:, 2]
+
+
+def load_recipe_matrix(conn):
+    """Matrix [Rezept_ID, Granulat_ID] -> Menge per bottle."""
+    data = np.array(
+        conn.execute("SELECT Rezept_ID, Granulat_ID, Menge FROM Rezept_besteht_aus_Granulat").fetchall(),
+        dtype=np.float64,
+    ).reshape(-1, 3)
+    rezept = data[:, 0].astype(np.int64)
+    granulat = data[:, 1].astype(np.int64)
+    shape = (rezept.max(initial=0) + 1, granulat.max(initial=0) + 1)
+    matrix = np.zeros(shape)
+    # A recipe can list the same granulate more than once, the quantities add up
+    np.add.at(matrix, (rezept, granulat), data[:, 2])
+    return matrix
+
+
+def load_recipe_mix(conn, since, recipes):
+    """Number of bottles per Rezept_ID tagged since `since`."""
+    data = np.array(conn.execute("""
+        SELECT Rezept_ID, COUNT(*) FROM Flasche
+        WHERE Tagged_Date >= ? AND Rezept_ID IS NOT NULL
+        GROUP BY Rezept_ID
+    """, (since.isoformat(sep=" "),)).fetchall(), dtype=np.int64).reshape(-1, 2)
+    counts = np.zeros(recipes, dtype=np.float64)
+    known = data[:, 0] < recipes
+    counts[data[known, 0]] = data[known, 1]
+    return counts
+
+
+def consumption_rates(dispenser, hours, level):
+    """
+    Per dispenser: ids, current level and consumed level units per hour. Rises
+    in the fill level are refills and do not count as negative consumption.
+    """
+    ids, first_index, inverse = np.unique(dispenser, return_index=True, return_inverse=True)
+    if len(ids) == 0:
+        empty = np.zeros(0)
+        return ids, empty, empty
+    last_index = np.r_[first_index[1:], len(dispenser)] - 1
+    same = inverse[1:] == inverse[:-1]
+    drop = np.where(same, level[:-1] - level[1:], 0.0).clip(min=0.0)
+    consumed = np.bincount(inverse[1:], weights=drop, minlength=len(ids))
+    span = hours[last_index] - hours[first_index]
+    rate = np.divide(consumed, span, out=np.zeros_like(consumed), where=span > 0)
+    return ids, level[last_index], rate
+
+
+def forecast(conn, now=None, history=HISTORY, mix_window=MIX_WINDOW, capacity=None, granulat_of=None):
+    """
+    Forecast time-to-empty for every dispenser with fill level history.
+    `granulat_of` maps Dispenser_ID -> Granulat_ID (default: same number).
+    `capacity` maps Dispenser_ID -> Menge units per fill level unit; without
+    it no demand-based time-to-empty can be computed and that field is NaN.
+    """
+    now = now or datetime.now()
+    dispenser, hours, level = load_levels(conn, now - history)
+    ids, current, rate = consumption_rates(dispenser, hours, level)
+    hours_to_empty = np.divide(current, rate, out=np.full_like(current, np.inf), where=rate > 0)
+
+    matrix = load_recipe_matrix(conn)
+    mix = load_recipe_mix(conn, now - mix_window, matrix.shape[0])
+    demand_by_granulat = mix @ matrix / (mix_window.total_seconds() / 3600.0)
+
+    granulat = ids if granulat_of is None else np.array([granulat_of.get(int(i), -1) for i in ids], dtype=np.int64)
+    valid = (granulat >= 0) & (granulat < len(demand_by_granulat))
+    demand = np.zeros(len(ids))
+    demand[valid] = demand_by_granulat[granulat[valid]]
+
+    by_demand = np.full(len(ids), np.nan)
+    if capacity is not None:
+        cap = np.array([capacity.get(int(i), np.nan) for i in ids], dtype=np.float64)
+        by_demand = np.divide(current * cap, demand, out=np.full(len(ids), np.inf), where=demand > 0)
+        by_demand[np.isnan(cap)] = np.nan
+
+    return Forecast(ids, current, rate, hours_to_empty, demand, by_demand)
+
+
+if __name__ == "__main__":
+    import sqlite3
+    import sys
+    import time
+    import db_migrations
+
+    logging.basicConfig(level=logging.INFO)
+    db_path = sys.argv[1] if len(sys.argv) > 1 else db_migrations.DEFAULT_DB_PATH
+    db_migrations.ensure_schema(db_path)
+    conn = sqlite3.connect(db_path)
+    start = time.perf_counter()
+    result = forecast(conn)
+    logger.info("Forecast computed in %.1f ms", (time.perf_counter() - start) * 1000)
+    for row in zip(*result):
+        logger.info("Dispenser %d: level %.0f, %.2f/h used, empty in %.1f h, recipe demand %.1f/h", *row[:5])
+    conn.close()
@@ -1,3 +1,4 @@
+import asyncio
 import nfc_reader
 import logging
 
@@ -5,20 +6,22 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-if __name__ == "__main__":
 
-    nfc_reader = nfc_reader.NFCReader()
+async def main():
+    reader = nfc_reader.NFCReader()
 
     logger.info("Waiting for RFID/NFC card...")
-    while True:
-        uid = nfc_reader.read_passive_target(timeout=0.5)
-        print(".", end="")
-        if uid is None:
-            continue
-        logger.info("Found card with UID: %s", [hex(i) for i in uid])
-        break
+    uid = await reader.next_card()
+    logger.info("Found card with UID: %s", [hex(i) for i in uid])
+
+    image = await reader.run(reader.read_all_blocks, uid)
+    for block_number in range(nfc_reader.BLOCK_COUNT):
+        if image.is_valid(block_number):
+            logger.info("Data in Block %d: %s", block_number, image.hex(block_number))
+        else:
+            logger.info("Block %d could not be read", block_number)
+    reader.close()
 
-    blocks_data = nfc_reader.read_all_blocks(uid)
-    for block_number, block_data in enumerate(blocks_data):
-        hex_values = " ".join([f"{byte:02x}" for byte in block_data])
-        logger.info("Data in Block %d: %s", block_number, hex_values)
+
+if __name__ == "__main__":
+    asyncio.run(main())
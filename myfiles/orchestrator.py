@@ -0,0 +1,162 @@
+# Runs every station of one Raspberry Pi as an asyncio task in a single process.
+# The stations share one SPI bus (reader_manager), one DB writer thread, one
+# Flaschen_ID allocator, one database.Database, one log file and one metrics endpoint,
+# instead of N processes each opening the DB and competing for its write lock.
+#
+# Usage: python orchestrator.py [--stations name:role:cs_pin[:irq_pin],...] [--metrics] [--emulate]
+import argparse
+import asyncio
+from collections import namedtuple
+import functools
+import logging
+import signal
+import sys
+
+import log_pipeline
+import metrics
+import nfc_reader
+import pn532_emulator
+import station1
+import station2
+import station_service
+from bottle_ids import BottleIdAllocator
+from database import Database
+from db_writer import WriteBehindWriter
+from reader_manager import ReaderConfig, ReaderManager
+
+logger = logging.getLogger("orchestrator")
+
+DB_PATH = "../data/flaschen_database.db"
+LOG_FILE = "stations.log"
+LOG_FORMAT = "[%(asctime)s] %(name)s: %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
+METRICS_PORT = 9100
+
+ROLES = ("station1", "station2")
+# `role` is station1 (tagging) or station2 (dosing); pins are `board` pin names
+StationConfig = namedtuple("StationConfig", ["name", "role", "cs_pin", "irq_pin"], defaults=[None])
+DEFAULT_STATIONS = [
+    StationConfig("station1", "station1", "D8"),
+    StationConfig("station2", "station2", "D5"),
+]
+
+# How long one poll may hold the shared bus waiting for a card
+POLL_SLICE = 0.02
+# With an IRQ pin only the GPIO is sampled while waiting, a listen may last longer
+IRQ_LISTEN_TIMEOUT = 1.0
+# Backpressure: a station blocks on its next bottle while this many DB writes or
+# checks are still queued, so a slow SD card slows the line instead of filling memory
+MAX_PENDING_WRITES = 500
+MAX_PENDING_CONFIRMS = 200
+
+
+def parse_stations(text):
+    """'name:role:cs_pin[:irq_pin],...' -> [StationConfig]"""
+    stations = []
+    for entry in text.split(","):
+        fields = entry.split(":")
+        if len(fields) not in (3, 4) or fields[1] not in ROLES:
+            raise ValueError(f"Invalid station {entry!r}, expected name:role:cs_pin[:irq_pin] with role in {ROLES}")
+        stations.append(StationConfig(*fields))
+    return stations
+
+
+class SharedServices:
+    """Everything the stations share. Create and close it once per process."""
+
+    def __init__(self, db_path):
+        # Shared by the reader threads, one pool of read connections and one writer
+        self.db = Database(db_path)
+        self.allocator = BottleIdAllocator(self.db)
+        self.writer = WriteBehindWriter(self.db, max_queue=MAX_PENDING_WRITES)
+        self.confirmer = station2.DbConfirmer(self.db, max_pending=MAX_PENDING_CONFIRMS)
+
+    def handler(self, role, reader):
+        if role == "station1":
+            return lambda uid: station1.tag_bottle(reader, uid, self.allocator, self.writer, self.db)
+        return lambda uid: station2.dispense(reader, self.db, uid, self.confirmer)
+
+    def close(self):
+        # The writer first: every tagged bottle is committed before the process exits
+        self.writer.close()
+        logger.info("DB writer: %s", self.writer.metrics())
+        self.allocator.close()
+        self.confirmer.close()
+        logger.info("DB-Abgleich: %d Abweichungen, %d nicht bestätigt",
+                    self.confirmer.mismatches, self.confirmer.unconfirmed)
+        self.db.close()
+
+
+def setup_logging():
+    # One queue and one file for all stations, the records carry the station's logger name
+    log_pipeline.attach(None, LOG_FILE, level=logging.INFO, fmt=LOG_FORMAT, datefmt=LOG_DATEFMT)
+
+
+def _station_ended(name, task):
+    # Logged right away, the other stations keep running until shutdown
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Station %s stopped with an error: %r", name, task.exception(), exc_info=task.exception())
+
+
+async def run(stations, services, manager):
+    """Serve all stations until SIGTERM or SIGINT. Returns {station name: CycleStats}."""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    tasks = {}
+    for station in stations:
+        reader = manager.readers[station.name]
+        max_targets = nfc_reader.MAX_TARGETS if station.role == "station1" else 1
+        irq = manager.irq(station.name)
+        tasks[station.name] = asyncio.ensure_future(station_service.serve(
+            reader, services.handler(station.role, reader), station.name, max_targets=max_targets, stop=stop,
+            listen_timeout=POLL_SLICE if irq is None else IRQ_LISTEN_TIMEOUT, irq=irq))
+        tasks[station.name].add_done_callback(functools.partial(_station_ended, station.name))
+    try:
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+
+    stats = {}
+    for name, result in zip(tasks, results):
+        if not isinstance(result, BaseException):
+            stats[name] = result
+    return stats
+
+
+def main(stations=DEFAULT_STATIONS, db_path=DB_PATH, pn532_factory=None):
+    setup_logging()
+    logger.info("Stationen gestartet: %s", ", ".join(f"{s.name} ({s.role})" for s in stations))
+    services = SharedServices(db_path)
+    manager = None
+    try:
+        manager = ReaderManager(
+            [ReaderConfig(s.name, s.cs_pin, s.irq_pin) for s in stations], pn532_factory=pn532_factory)
+        stats = asyncio.run(run(stations, services, manager))
+        for name, station_stats in stats.items():
+            logger.info("%s: %s", name, station_stats.summary())
+        logger.info("Reader: %s", manager.stats_snapshot())
+    finally:
+        if manager is not None:
+            manager.close()
+        services.close()
+        logger.info("Stationen beendet")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run all stations in one process")
+    parser.add_argument("--stations", type=parse_stations, default=DEFAULT_STATIONS,
+                        help="comma separated name:role:cs_pin[:irq_pin]")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--metrics", action="store_true", help=f"serve metrics on port {METRICS_PORT}")
+    parser.add_argument("--emulate", action="store_true", help="emulated readers, no hardware needed")
+    args = parser.parse_args()
+    if args.metrics:
+        # Enabled before the readers are created, so their PN532 commands are timed too
+        metrics.enable()
+        metrics.serve_http(METRICS_PORT)
+    factory = (lambda config: pn532_emulator.EmulatedPN532([])) if args.emulate else None
+    sys.exit(main(args.stations, args.db, factory))
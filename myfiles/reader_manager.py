@@ -0,0 +1,317 @@
+# Drives several PN532 readers that share one SPI bus, each with its own chip select.
+# The bus is taken per SPI transfer, not per command: while one PN532 talks to its
+# card over RF the bus is free for the others, so the readers work in parallel.
+from collections import namedtuple
+import logging
+import threading
+import time
+
+from nfc_reader import NFCReader
+
+try:
+    import board
+    import busio
+    from digitalio import DigitalInOut
+    from adafruit_pn532.spi import PN532_SPI, reverse_bit, _SPI_READY, _SPI_STATREAD
+except (ImportError, NotImplementedError):
+    # No Blinka/PN532 stack on this machine, only emulated readers can be used
+    board = busio = DigitalInOut = PN532_SPI = None
+
+
+logger = logging.getLogger("shared_logger")
+
+# _poll_reader() result of a listen window that ended without a card
+NO_CARD = object()
+
+# One entry per reader. `cs_pin` and `irq_pin` are `board` pin names, e.g. "D8".
+ReaderConfig = namedtuple("ReaderConfig", ["name", "cs_pin", "irq_pin"], defaults=[None])
+
+# Example configuration for one Raspberry Pi: both gates of station 1 and two lanes of station 2
+DEFAULT_READERS = [
+    ReaderConfig("station1_in", "D8"),
+    ReaderConfig("station1_out", "D7"),
+    ReaderConfig("station2_lane1", "D5"),
+    ReaderConfig("station2_lane2", "D6"),
+]
+
+
+class ReaderStats:
+    """
+    Bus use of one reader. Polls and cards are counted by its NFCReader
+    (`reader`), whether it is polled by poll_once() or by its own async API.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.transfers = 0
+        self.bus_wait = 0.0
+        self.bus_busy = 0.0
+        self.reader = None
+
+    @property
+    def polls(self):
+        return self.reader.polls if self.reader is not None else 0
+
+    @property
+    def cards(self):
+        return self.reader.cards_found if self.reader is not None else 0
+
+    def tags_per_second(self):
+        elapsed = time.monotonic() - self.started
+        return self.cards / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self):
+        return {
+            "transfers": self.transfers,
+            "bus_wait_s": round(self.bus_wait, 6),
+            "bus_busy_s": round(self.bus_busy, 6),
+            "polls": self.polls,
+            "cards": self.cards,
+            "tags_per_second": round(self.tags_per_second(), 3),
+        }
+
+
+class SPIBusArbiter:
+    """
+    Serializes the transfers on the shared SPI bus. The lock is reentrant for the
+    owning thread and handed out in request order, so a busy reader cannot starve
+    the others.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self._owner = None
+        self._depth = 0
+
+    def acquire(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while self._serving != ticket:
+                self._cond.wait()
+            self._owner = me
+            self._depth = 1
+
+    def release(self):
+        with self._cond:
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._serving += 1
+                self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+    def attach(self, pn532, stats=None):
+        """
+        Route the SPI transfers of `pn532` through the arbiter by wrapping its
+        SPIDevice (`_spi`, as in PN532_SPI and EmulatedPN532). Returns `pn532`.
+        """
+        pn532._spi = ArbitratedSPIDevice(pn532._spi, self, stats)
+        return pn532
+
+
+class ArbitratedSPIDevice:
+    """
+    Stands in for the SPIDevice of one PN532: every `with device as spi:` block,
+    i.e. one transfer with chip select asserted, holds the bus lock. The
+    SPIDevice itself still locks busio.SPI; the arbiter adds the fair order and
+    the bus statistics. Used by one thread at a time, like the PN532 it belongs to.
+    """
+
+    def __init__(self, device, arbiter, stats=None):
+        self._device = device
+        self._arbiter = arbiter
+        self.stats = stats or ReaderStats()
+        self._acquired = None
+
+    def __enter__(self):
+        requested = time.monotonic()
+        self._arbiter.acquire()
+        try:
+            spi = self._device.__enter__()
+        except BaseException:
+            self._arbiter.release()
+            raise
+        self._acquired = time.monotonic()
+        self.stats.transfers += 1
+        self.stats.bus_wait += self._acquired - requested
+        return spi
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            return self._device.__exit__(exc_type, exc, tb)
+        finally:
+            self.stats.bus_busy += time.monotonic() - self._acquired
+            self._arbiter.release()
+
+
+if PN532_SPI is not None:
+    class SharedBusPN532(PN532_SPI):
+        """
+        PN532_SPI for a shared bus. The stock _wait_ready() keeps the chip selected
+        while the PN532 works on a command (RF exchange and card wait included);
+        this one takes the bus for each status read only.
+        """
+
+        def _wait_ready(self, timeout=1):
+            status_cmd = bytearray([reverse_bit(_SPI_STATREAD), 0x00])
+            status_response = bytearray([0x00, 0x00])
+            timestamp = time.monotonic()
+            while (time.monotonic() - timestamp) < timeout:
+                with self._spi as spi:
+                    spi.write_readinto(status_cmd, status_response)
+                if reverse_bit(status_response[1]) == _SPI_READY:
+                    return True
+                time.sleep(0.01)
+            return False
+
+
+class ReaderManager:
+    """
+    Owns one SPI bus and an NFCReader per configured chip select. cards() polls
+    the readers round-robin and yields (reader_name, uid) for every card that
+    enters a reader's field. The station logic for a reader can run on its own
+    thread; the arbiter keeps the SPI transfers of all readers apart.
+    """
+
+    def __init__(self, configs=DEFAULT_READERS, pn532_factory=None, poll_slice=0.02, cache_factory=None,
+                 listen_timeout=1.0):
+        """
+        `pn532_factory(config)` builds the PN532 for a reader, by default a
+        SharedBusPN532 on the shared bus; it needs its SPIDevice in `_spi`.
+        `poll_slice` is how long one reader may wait for a card per round.
+        `cache_factory()` optionally builds a BlockCache per reader. A listen
+        command left unanswered for `listen_timeout` seconds counts as an empty
+        field, a card on that reader is reported again after it.
+        """
+        self.arbiter = SPIBusArbiter()
+        self.poll_slice = poll_slice
+        self.listen_timeout = listen_timeout
+        self.readers = {}
+        self.stats = {}
+        self._irq = {}
+        self._listening = {}
+        self._last_uid = {}
+        self._next = 0
+        self._spi = None
+
+        for config in configs:
+            stats = ReaderStats()
+            if pn532_factory is None:
+                pn532 = self._spi_pn532(config)
+            else:
+                pn532 = pn532_factory(config)
+            cache = cache_factory() if cache_factory else None
+            stats.reader = NFCReader(self.arbiter.attach(pn532, stats), cache=cache)
+            self.readers[config.name] = stats.reader
+            self.stats[config.name] = stats
+            self._irq[config.name] = self._irq_pin(config, pn532)
+            self._listening[config.name] = None
+            self._last_uid[config.name] = None
+        logger.info("Reader manager started with readers: %s", ", ".join(self.readers))
+
+    def _spi_pn532(self, config):
+        if PN532_SPI is None:
+            raise RuntimeError("adafruit-blinka/adafruit-pn532 are not available")
+        with self.arbiter:
+            if self._spi is None:
+                self._spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
+            cs_pin = DigitalInOut(getattr(board, config.cs_pin))
+            return SharedBusPN532(self._spi, cs_pin, debug=False)
+
+    @staticmethod
+    def _irq_pin(config, pn532):
+        if config.irq_pin is None:
+            return getattr(pn532, "irq", None)
+        return DigitalInOut(getattr(board, config.irq_pin))
+
+    def irq(self, name):
+        """The IRQ input of reader `name`, None if it has none; for NFCReader.cards() and card_batches()."""
+        return self._irq[name]
+
+    def _poll_reader(self, name):
+        # The UID of a card, None while the listen command is still pending, or
+        # NO_CARD once a listen ended without a card
+        reader = self.readers[name]
+        reader.polls += 1
+        if self._listening[name] is None:
+            if not reader.listen_for_passive_target(timeout=self.poll_slice):
+                return NO_CARD
+            # When the listen command went out
+            self._listening[name] = time.monotonic()
+        irq = self._irq[name]
+        if irq is None or not irq.value:
+            # With IRQ the PN532 is only asked once it is low, checking the pin costs no bus time
+            uid = reader.get_passive_target(timeout=self.poll_slice)
+            if uid is not None:
+                self._listening[name] = None
+                return bytes(uid)
+        if time.monotonic() - self._listening[name] >= self.listen_timeout:
+            # No card for a whole listen window, the next round listens anew
+            self._listening[name] = None
+            return NO_CARD
+        return None
+
+    def poll_once(self):
+        """One round over all readers, starting one reader later than last time."""
+        names = list(self.readers)
+        start = self._next % len(names)
+        self._next += 1
+        found = []
+        for name in names[start:] + names[:start]:
+            uid = self._poll_reader(name)
+            if uid is None:
+                continue
+            if uid is NO_CARD:
+                self._last_uid[name] = None
+                continue
+            if uid == self._last_uid[name]:
+                continue
+            self._last_uid[name] = uid
+            self.readers[name].cards_found += 1
+            found.append((name, uid))
+        return found
+
+    def cards(self, idle_interval=0.005):
+        while True:
+            found = self.poll_once()
+            if not found:
+                # Nothing in any field, don't spin on the IRQ pins
+                time.sleep(idle_interval)
+            for name, uid in found:
+                yield name, uid
+
+    def stats_snapshot(self):
+        snapshot = {name: stats.as_dict() for name, stats in self.stats.items()}
+        snapshot["total_tags_per_second"] = round(
+            sum(stats.tags_per_second() for stats in self.stats.values()), 3
+        )
+        return snapshot
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    manager = ReaderManager()
+    logger.info("Waiting for RFID/NFC cards...")
+    try:
+        for name, uid in manager.cards():
+            logger.info("Reader %s found card with UID: %s", name, uid.hex(":"))
+    except KeyboardInterrupt:
+        logger.info("Reader stats: %s", manager.stats_snapshot())
+        manager.close()
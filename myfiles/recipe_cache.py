@@ -0,0 +1,96 @@
+# In-memory copy of Rezept and Rezept_besteht_aus_Granulat for station 2. The
+# dosing decision is made from memory; the tables are only read again when a
+# change counter maintained by triggers moves. The counter and its triggers are
+# created by db_migrations (migration 4).
+import logging
+import threading
+import metrics
+
+logger = logging.getLogger("recipe_cache")
+
+LOOKUP_LATENCY = metrics.histogram("recipe_lookup_seconds", "Duration of recipe lookups by Flaschen_ID")
+RELOAD_LATENCY = metrics.histogram("recipe_reload_seconds", "Duration of loading the recipe tables")
+
+class RecipeCatalog:
+    """
+    Recipes by Rezept_ID with their dosing lists as tuples of (Granulat_ID, Menge)
+    sorted by Granulat_ID. Before every lookup `PRAGMA data_version` is checked,
+    which costs no I/O; only if another connection committed is the change
+    counter read, and only if that moved are the tables loaded again.
+    Calls from several threads take turns on the connection, which only reads;
+    the database has to be migrated (db_migrations.ensure_schema).
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.RLock()
+        self.reloads = 0
+        self._data_version = None
+        self._catalog_version = None
+        self._stueckzahl = {}
+        self._mengen = {}
+        self.refresh()
+
+    def _read_catalog_version(self):
+        return self._conn.execute("SELECT Version FROM Katalog_Version WHERE Id = 1").fetchone()[0]
+
+    @metrics.timed(RELOAD_LATENCY)
+    def _load(self):
+        self._stueckzahl = dict(self._conn.execute("SELECT Rezept_ID, Stueckzahl FROM Rezept"))
+        mengen = {}
+        for rezept_id, granulat_id, menge in self._conn.execute("""
+            SELECT Rezept_ID, Granulat_ID, Menge
+            FROM Rezept_besteht_aus_Granulat
+            ORDER BY Rezept_ID, Granulat_ID
+        """):
+            mengen.setdefault(rezept_id, []).append((granulat_id, menge))
+        self._mengen = {rezept_id: tuple(rows) for rezept_id, rows in mengen.items()}
+        self.reloads += 1
+        logger.info("Loaded %d recipes", len(self._mengen))
+
+    def refresh(self):
+        with self._lock:
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return False
+            self._data_version = data_version
+            catalog_version = self._read_catalog_version()
+            if catalog_version == self._catalog_version:
+                return False
+            self._catalog_version = catalog_version
+            self._load()
+            return True
+
+    def invalidate(self):
+        # data_version does not move for commits made on our own connection
+        with self._lock:
+            self._data_version = None
+            self._catalog_version = None
+
+    def mengen(self, rezept_id):
+        self.refresh()
+        return self._mengen.get(rezept_id, ())
+
+    def stueckzahl(self, rezept_id):
+        self.refresh()
+        return self._stueckzahl.get(rezept_id)
+
+    def rezept_ids(self):
+        self.refresh()
+        return sorted(self._mengen)
+
+    @metrics.timed(LOOKUP_LATENCY)
+    def lookup(self, flaschen_id):
+        """Rezept_ID and dosing list of a bottle: one primary key lookup, the rest from memory."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT Rezept_ID FROM Flasche WHERE Flaschen_ID = ?", (flaschen_id,)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None, ()
+        rezept_id = int(row[0])
+        return rezept_id, self.mengen(rezept_id)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,206 @@
+# Event-driven state machines on asyncio. States and transitions are declared as
+# data; a state waits for its next event (posted from outside, returned by the
+# state's activity, or its timeout) instead of polling, so any number of machines
+# can share one event loop without keeping a CPU core busy.
+import asyncio
+from collections import deque, namedtuple
+import inspect
+import logging
+import re
+import time
+import metrics
+
+logger = logging.getLogger("state_machine")
+
+# Built-in events: a state's timeout expired / its activity raised
+TIMEOUT = "timeout"
+ERROR = "error"
+# Source of a transition that applies in every state
+ANY = "*"
+
+# Seconds. A station waits anything from milliseconds (writing a tag) to minutes (no bottle).
+DWELL_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+
+Transition = namedtuple("Transition", ["source", "event", "target"])
+
+
+class State:
+    """
+    One state of a machine. `on_enter` and `on_exit` are called with the machine,
+    as plain functions or coroutines; an event returned by `on_enter` is handled
+    right away. `activity` is a coroutine function started after entering, the
+    event it returns is handled like a posted one and it is cancelled when the
+    state is left before it finished. Without an event for `timeout` seconds the
+    TIMEOUT event is raised. Entering a `terminal` state ends the machine.
+    """
+
+    def __init__(self, name, on_enter=None, on_exit=None, activity=None, timeout=None, terminal=False):
+        self.name = name
+        self.on_enter = on_enter
+        self.on_exit = on_exit
+        self.activity = activity
+        self.timeout = timeout
+        self.terminal = terminal
+
+    def __repr__(self):
+        return "State(%r)" % self.name
+
+
+def _metric_name(name):
+    return re.sub(r"[^0-9a-zA-Z_]", "_", name).lower()
+
+
+async def _call(hook, machine):
+    if hook is None:
+        return None
+    result = hook(machine)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+class StateMachine:
+    """
+    `states` is a list of State, `transitions` a list of (source, event, target)
+    tuples; a source of ANY matches every state, a transition for the current
+    state wins over an ANY one. Events without a transition are logged and
+    ignored. `context` is free for the hooks, e.g. the station's reader.
+    The time spent in every state is kept in `dwell` ({state: [visits, seconds]})
+    and recorded in a histogram per state while metrics are enabled.
+    """
+
+    def __init__(self, name, states, transitions, initial, context=None):
+        self.name = name
+        self.states = {state.name: state for state in states}
+        if initial not in self.states:
+            raise ValueError(f"Unknown initial state {initial!r}")
+        self.initial = initial
+        self.context = context
+        self.current = None
+        self.dwell = {state_name: [0, 0.0] for state_name in self.states}
+        self._table = {}
+        for transition in transitions:
+            transition = Transition(*transition)
+            for state_name in (transition.source, transition.target):
+                if state_name != ANY and state_name not in self.states:
+                    raise ValueError(f"Transition {transition} refers to unknown state {state_name!r}")
+            self._table[(transition.source, transition.event)] = transition.target
+        self._histograms = {
+            state_name: metrics.histogram(
+                f"state_{_metric_name(name)}_{_metric_name(state_name)}_dwell_seconds",
+                f"Time state machine {name} spent in state {state_name}",
+                DWELL_BUCKETS,
+            )
+            for state_name in self.states
+        }
+        self._pending = deque()
+        self._posted = None
+        self._loop = None
+
+    def target(self, state_name, event):
+        """The state `event` leads to from `state_name`, None if there is no transition."""
+        target = self._table.get((state_name, event))
+        return self._table.get((ANY, event)) if target is None else target
+
+    def post(self, event):
+        """Queue an event for the machine. Call from the event loop, see post_threadsafe()."""
+        self._pending.append(event)
+        if self._posted is not None:
+            self._posted.set()
+
+    def post_threadsafe(self, event):
+        """Queue an event from another thread, e.g. a GPIO callback."""
+        if self._loop is None:
+            raise RuntimeError(f"State machine {self.name} is not running")
+        self._loop.call_soon_threadsafe(self.post, event)
+
+    async def run(self):
+        """Run until a terminal state is entered and return its name. Cancel the task to stop early."""
+        self._loop = asyncio.get_running_loop()
+        # Created here, before Python 3.10 an Event is bound to the loop it was made in
+        self._posted = asyncio.Event()
+        state = self.states[self.initial]
+        try:
+            while True:
+                self.current = state.name
+                entered = time.perf_counter()
+                logger.debug("%s: entering %s", self.name, state.name)
+                activity = None
+                try:
+                    event = await _call(state.on_enter, self)
+                    if state.terminal:
+                        self._record(state, entered)
+                        return state.name
+                    if event is None and state.activity is not None:
+                        activity = asyncio.ensure_future(state.activity(self))
+                    if event is None or self.target(state.name, event) is None:
+                        if event is not None:
+                            logger.warning("%s: event %r ignored in state %s", self.name, event, state.name)
+                        event = await self._next_event(state, activity)
+                finally:
+                    if activity is not None and not activity.done():
+                        activity.cancel()
+                        await asyncio.gather(activity, return_exceptions=True)
+
+                await _call(state.on_exit, self)
+                self._record(state, entered)
+                target = self.target(state.name, event)
+                logger.debug("%s: %s --%s--> %s", self.name, state.name, event, target)
+                state = self.states[target]
+        finally:
+            self._loop = self._posted = None
+
+    async def _next_event(self, state, activity):
+        # The first event with a transition out of `state`
+        loop = asyncio.get_running_loop()
+        deadline = None if state.timeout is None else loop.time() + state.timeout
+        while True:
+            if self._pending:
+                event = self._pending.popleft()
+            else:
+                self._posted.clear()
+                posted = asyncio.ensure_future(self._posted.wait())
+                waits = {posted} if activity is None else {posted, activity}
+                remaining = None if deadline is None else max(0.0, deadline - loop.time())
+                try:
+                    done, _ = await asyncio.wait(waits, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    posted.cancel()
+                if activity is not None and activity in done:
+                    event = self._activity_event(state, activity)
+                    activity = None
+                    if event is None:
+                        # Finished without an event, keep waiting for posted ones
+                        continue
+                elif not done:
+                    event = TIMEOUT
+                    # A timeout without a transition fires once per visit
+                    deadline = None
+                else:
+                    continue
+
+            if self.target(state.name, event) is not None:
+                return event
+            logger.warning("%s: event %r ignored in state %s", self.name, event, state.name)
+
+    def _activity_event(self, state, activity):
+        try:
+            return activity.result()
+        except asyncio.CancelledError:
+            return None
+        except Exception as e:
+            logger.exception("%s: activity of state %s failed: %s", self.name, state.name, e)
+            return ERROR
+
+    def _record(self, state, entered):
+        elapsed = time.perf_counter() - entered
+        dwell = self.dwell[state.name]
+        dwell[0] += 1
+        dwell[1] += elapsed
+        if metrics.is_enabled():
+            self._histograms[state.name].observe(elapsed)
+
+
+async def run_all(machines):
+    """Run several machines side by side in the running event loop. Returns their final states."""
+    return await asyncio.gather(*(machine.run() for machine in machines))
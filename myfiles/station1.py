@@ -1,76 +1,107 @@
-import sqlite3
+import asyncio
 from datetime import datetime
 import nfc_reader
+import log_pipeline
+import metrics
 import logging
 import random
-sign = b"AHTS"
+import sys
+import station_service
+import tag_codec
+from bottle_ids import BottleIdAllocator
+from database import Database
+from db_writer import WriteBehindWriter
 
 PATH = "../data/flaschen_database.db"
-BLOCK_NUMBER = 4
+BLOCK_NUMBER = tag_codec.HEADER_BLOCK
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("station1")
 
-def pack_flaschen_id(fid: int) -> bytes: # Flaschen ID in 16 bytes für die RFIDs
-    return sign + fid.to_bytes(4, "little") + bytes(8)
+LOG_FILE = "station1.log"
+LOG_FORMAT = "[%(asctime)s] %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
+METRICS_PORT = 9101
 
-def unpack_flaschen_id(block: bytes): # liest 16 Byte Block und sucht die Flaschen-ID
-    if not block or len(block) != 16:
-        return None
-    if block[:4] != sign: # sign falsch -> keine chance
-        return None
-    fid = int.from_bytes(block[4:8], "little") # 4-7 als Zahl
-    return fid if fid > 0 else None
+def setup_logging():
+    # The log file is written by a background thread, a bottle cycle never opens it
+    log_pipeline.attach(logger, LOG_FILE, level=logging.INFO, fmt=LOG_FORMAT, datefmt=LOG_DATEFMT)
 
-def log(msg: str):
-    with open("station1.log", "a") as f:
-        f.write(f"[{datetime.now().isoformat(sep=' ', timespec='seconds')}] {msg}\n")
-
-def next_free_bottle_id(cur):
-    cur.execute("SELECT MAX(Flaschen_ID) FROM Flasche")
-    result = cur.fetchone()[0]
-    return 1 if result is None else int(result) + 1
-
-def main():
-    log("Station 1 gestartet")
-    reader = nfc_reader.NFCReader()
-    logger.info("Waiting for RFID/NFC card...")
-    while True:
-        uid = reader.read_passive_target(timeout=0.5)
-        print(".", end="")
-        if uid is None:
-            continue
-        logger.info("Found card with UID: %s", [hex(i) for i in uid])
-        break
-
-    uid = bytes(uid)
+def tag_bottle(reader, uid, allocator, writer, db):
+    # Only the header block, a blank tag needs no more than that
     existing = reader.read_block(uid, BLOCK_NUMBER)
-    existing_id = unpack_flaschen_id(existing)
+    existing_id = tag_codec.peek_flaschen_id(existing) if existing else None
     if existing_id is not None:
-        log(f"Bereits getaggt: FlaschenID = {existing_id} (kein neues Tagging)")
-        return
-    conn = sqlite3.connect(PATH)
-    cursor = conn.cursor()
+        logger.info("Bereits getaggt: FlaschenID = %d (kein neues Tagging)", existing_id)
+        return True
     rezept_id = random.randint(1,3)
     try:
-        flaschen_id = next_free_bottle_id(cursor)
-        data = pack_flaschen_id(flaschen_id)
-        ok = reader.write_block(uid, BLOCK_NUMBER, data)
-        log(f"FlaschenID vergeben! ID = {flaschen_id}")
-
-        cursor.execute("""
-            INSERT INTO Flasche (Flaschen_ID, Rezept_ID, Tagged_Date, has_error)
-            VALUES (?, ?, ?, ?)
-        """, (flaschen_id, rezept_id, datetime.now(), False))
+        flaschen_id = allocator.next_id()
+        # Rezept and Mengen go onto the tag too, station 2 doses without asking the DB
+        payload = tag_codec.encode(flaschen_id, rezept_id, db.mengen(rezept_id))
+        if not tag_codec.write(reader, uid, payload):
+            logger.error("FEHLER: FlaschenID %d konnte nicht auf den Tag geschrieben werden", flaschen_id)
+            return False
+        logger.info("FlaschenID vergeben! ID = %d", flaschen_id)
 
-        conn.commit()
-        log(f"Flaschen-ID {flaschen_id} erfolgreich gespeichert")
+        # Written by the background writer, the RFID loop does not wait for the commit
+        writer.submit((flaschen_id, rezept_id, datetime.now(), False))
+        logger.info("Flaschen-ID %d zum Speichern eingereiht", flaschen_id)
+        return True
 
     except Exception as e:
-        log(f"FEHLER: {e}")
+        logger.error("FEHLER: %s", e)
+        return False
+
+def main(reader=None):
+    setup_logging()
+    logger.info("Station 1 gestartet")
+    db = Database(PATH)
+    if reader is None:
+        reader = nfc_reader.NFCReader()
+    logger.info("Waiting for RFID/NFC card...")
+    uid = asyncio.run(reader.next_card())
+    logger.info("Found card with UID: %s", [hex(i) for i in uid])
+
+    # A single bottle only needs a single ID, a bigger block would leave a gap
+    allocator = BottleIdAllocator(db, block_size=1)
+    writer = WriteBehindWriter(db)
+    try:
+        tag_bottle(reader, uid, allocator, writer, db)
+    finally:
+        writer.close()
+        allocator.close()
+        db.close()
 
+def serve(reader=None, max_targets=nfc_reader.MAX_TARGETS):
+    # Service mode: reader and DB connection stay open, one cycle per bottle.
+    # Two bottles close together on the belt are selected by the same poll.
+    setup_logging()
+    logger.info("Station 1 gestartet (Service)")
+    db = Database(PATH)
+    if reader is None:
+        reader = nfc_reader.NFCReader()
+    allocator = BottleIdAllocator(db)
+    writer = WriteBehindWriter(db)
+    try:
+        asyncio.run(station_service.serve(
+            reader, lambda uid: tag_bottle(reader, uid, allocator, writer, db), "station1",
+            max_targets=max_targets))
     finally:
-        conn.close()
-    
+        # Flushes every queued bottle before the process exits
+        writer.close()
+        logger.info("DB writer: %s", writer.metrics())
+        allocator.close()
+        db.close()
+        reader.close()
+        logger.info("Station 1 beendet")
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if "--metrics" in sys.argv[1:]:
+        # Enabled before the reader is created, so its PN532 commands are timed too
+        metrics.enable()
+        metrics.serve_http(METRICS_PORT)
+    if "--service" in sys.argv[1:]:
+        serve(max_targets=1 if "--single-target" in sys.argv[1:] else nfc_reader.MAX_TARGETS)
+    else:
+        main()
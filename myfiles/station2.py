@@ -1,85 +1,195 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import sqlite3
-from datetime import datetime
 import logging
+import sys
+import threading
 import nfc_reader
+import log_pipeline
+import metrics
+import station_service
+import tag_codec
+from database import Database
 
 DB_PATH = "../data/flaschen_database.db"
-BLOCK_NUMBER = 4
-MAGIC = b"BOTL"
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("station2")
 
-def log(msg: str):
-    with open("station2.log", "a") as f:
-        f.write(f"[{datetime.now().isoformat(sep=' ', timespec='seconds')}] {msg}\n")
-
-def unpack_flaschen_id(block: bytes):
-    if not block or len(block) != 16:
-        return None
-    if block[:4] != MAGIC:
-        return None
-    fid = int.from_bytes(block[4:8], "little")
-    return fid if fid > 0 else None
-
-def get_rezept_id(cur, flaschen_id: int):
-    cur.execute("SELECT Rezept_ID FROM Flasche WHERE Flaschen_ID = ?", (flaschen_id,))
-    row = cur.fetchone()
-    return None if row is None else row[0]
-
-def get_granulat_mengen(cur, rezept_id: int):
-    cur.execute("""
-        SELECT Granulat_ID, Menge
-        FROM Rezept_besteht_aus_Granulat
-        WHERE Rezept_ID = ?
-        ORDER BY Granulat_ID
-    """, (rezept_id,))
-    return cur.fetchall()  # Liste von (Granulat_ID, Menge)
-
-def main():
-    log("Station 2 gestartet")
-
-    reader = nfc_reader.NFCReader()
+LOG_FILE = "station2.log"
+LOG_FORMAT = "[%(asctime)s] %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
+METRICS_PORT = 9102
+# A bottle can reach station 2 before station 1 has committed its row
+CONFIRM_RETRY_DELAY = 0.5
+CONFIRM_ATTEMPTS = 5
+
+UNCONFIRMED = metrics.counter("station2_unconfirmed_total", "Dosed bottles whose Flaschen_ID never showed up in the DB")
+
+def setup_logging():
+    # The log file is written by a background thread, a bottle cycle never opens it
+    log_pipeline.attach(logger, LOG_FILE, level=logging.INFO, fmt=LOG_FORMAT, datefmt=LOG_DATEFMT)
+
+class DbConfirmer:
+    """
+    Compares dosed bottles with the DB on its own thread; dosing itself only
+    uses the data on the tag. Differences are logged and counted. A bottle not
+    in the DB yet is looked up again every `retry_delay` seconds, `attempts`
+    times in all; if it never shows up it is counted in `unconfirmed`. With
+    `max_pending` submit() blocks while that many bottles wait for their check.
+    `db` is the database.Database to compare with.
+    """
+
+    def __init__(self, db, max_pending=0, retry_delay=CONFIRM_RETRY_DELAY, attempts=CONFIRM_ATTEMPTS):
+        self.mismatches = 0
+        self.unconfirmed = 0
+        self.retry_delay = retry_delay
+        self.attempts = attempts
+        self._db = db
+        self._slots = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="confirm")
+
+    def submit(self, payload):
+        # A bottle holds its slot until it is checked, retries included
+        if self._slots is not None:
+            self._slots.acquire()
+        with self._idle:
+            self._pending += 1
+        self._executor.submit(self._confirm, payload)
+
+    def _confirm(self, payload, attempt=1):
+        retry = False
+        try:
+            retry = self._compare(payload, attempt)
+        finally:
+            if retry:
+                # Waits on a timer, the confirm thread goes on with the next bottles
+                timer = threading.Timer(self.retry_delay, self._executor.submit, (self._confirm, payload, attempt + 1))
+                timer.daemon = True
+                timer.start()
+            else:
+                self._finished()
+
+    def _compare(self, payload, attempt):
+        # True if the bottle is not in the DB yet and is to be looked up again
+        try:
+            rezept_id, mengen = self._db.lookup(payload.flaschen_id)
+        except sqlite3.Error as e:
+            logger.warning("Abgleich von Flaschen_ID=%d mit der DB fehlgeschlagen: %s", payload.flaschen_id, e)
+            return False
+        if rezept_id is None:
+            # Station 1 commits in the background, a very fast bottle can overtake its row
+            if attempt < self.attempts:
+                logger.debug("Flaschen_ID=%d ist (noch) nicht in der DB, neuer Versuch", payload.flaschen_id)
+                return True
+            self.unconfirmed += 1
+            UNCONFIRMED.inc()
+            logger.error("FEHLER: Flaschen_ID=%d nach %d Versuchen nicht in der DB", payload.flaschen_id, attempt)
+        elif rezept_id != payload.rezept_id:
+            self.mismatches += 1
+            logger.error("FEHLER: Flaschen_ID=%d hat auf dem Tag Rezept_ID=%d, in der DB Rezept_ID=%d",
+                         payload.flaschen_id, payload.rezept_id, rezept_id)
+        elif tag_codec.quantize(mengen) != payload.mengen:
+            self.mismatches += 1
+            logger.warning("Flaschen_ID=%d: Mengen auf dem Tag weichen von Rezept_ID=%d in der DB ab",
+                           payload.flaschen_id, rezept_id)
+        return False
+
+    def _finished(self):
+        with self._idle:
+            self._pending -= 1
+            self._idle.notify_all()
+        if self._slots is not None:
+            self._slots.release()
+
+    def close(self):
+        """Wait until every submitted bottle is checked, pending retries included."""
+        with self._idle:
+            self._idle.wait_for(lambda: self._pending == 0)
+        self._executor.shutdown(wait=True)
+
+def dispense(reader, db, uid, confirmer=None):
+    try:
+        payload = tag_codec.read(reader, uid)
+    except tag_codec.TagPayloadError as e:
+        logger.error("FEHLER: Tag nicht lesbar: %s", e)
+        return False
+    if payload is None:
+        logger.error("FEHLER: Keine gültige Flaschen-ID auf dem Tag (nicht getaggt?)")
+        return False
+
+    flaschen_id = payload.flaschen_id
+    if payload.rezept_id is not None:
+        # Everything needed is on the tag, the DB is only asked afterwards
+        rezept_id, mengen = payload.rezept_id, payload.mengen
+        if confirmer is not None:
+            confirmer.submit(payload)
+    else:
+        # Tags written before the codec only carry the Flaschen_ID
+        rezept_id, mengen = db.lookup(flaschen_id)
+        if rezept_id is None:
+            logger.error("FEHLER: Flaschen_ID=%d nicht in DB oder Rezept_ID ist NULL", flaschen_id)
+            return False
+
+    if not mengen:
+        logger.error("FEHLER: Keine Granulat-Mengen für Rezept_ID=%d gefunden", rezept_id)
+        return False
+
+    # Log-Ausgabe für diese Flasche
+    parts = " | ".join([f"Granulat {gid}: {menge}" for gid, menge in mengen])
+    logger.info("Flaschen_ID=%d Rezept_ID=%d -> %s", flaschen_id, rezept_id, parts)
+
+    # Optional auch auf Konsole
+    print(f"\nFlaschen_ID={flaschen_id}, Rezept_ID={rezept_id}")
+    for gid, menge in mengen:
+        print(f"  Granulat {gid}: {menge}")
+    return True
+
+def main(reader=None):
+    setup_logging()
+    logger.info("Station 2 gestartet")
+    db = Database(DB_PATH)
+
+    if reader is None:
+        reader = nfc_reader.NFCReader()
     logger.info("Waiting for RFID/NFC bottle...")
 
-    uid = None
-    while uid is None:
-        uid = reader.read_passive_target(timeout=0.5)
-        print(".", end="", flush=True)
-
-    uid = bytes(uid)
+    uid = asyncio.run(reader.next_card())
     logger.info("Found card UID: %s", uid.hex(":"))
 
-    block = reader.read_block(uid, BLOCK_NUMBER)
-    flaschen_id = unpack_flaschen_id(block)
-    if flaschen_id is None:
-        log("FEHLER: Keine gültige Flaschen-ID auf dem Tag (nicht getaggt?)")
-        return
-
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    confirmer = DbConfirmer(db)
     try:
-        rezept_id = get_rezept_id(cur, flaschen_id)
-        if rezept_id is None:
-            log(f"FEHLER: Flaschen_ID={flaschen_id} nicht in DB oder Rezept_ID ist NULL")
-            return
-
-        mengen = get_granulat_mengen(cur, int(rezept_id))
-        if not mengen:
-            log(f"FEHLER: Keine Granulat-Mengen für Rezept_ID={rezept_id} gefunden")
-            return
-
-        # Log-Ausgabe für diese Flasche
-        parts = " | ".join([f"Granulat {gid}: {menge}" for gid, menge in mengen])
-        log(f"Flaschen_ID={flaschen_id} Rezept_ID={rezept_id} -> {parts}")
-
-        # Optional auch auf Konsole
-        print(f"\nFlaschen_ID={flaschen_id}, Rezept_ID={rezept_id}")
-        for gid, menge in mengen:
-            print(f"  Granulat {gid}: {menge}")
-
+        dispense(reader, db, uid, confirmer)
+    finally:
+        confirmer.close()
+        db.close()
+
+def serve(reader=None):
+    # Service mode: reader and DB connection stay open, one cycle per bottle
+    setup_logging()
+    logger.info("Station 2 gestartet (Service)")
+    db = Database(DB_PATH)
+    if reader is None:
+        reader = nfc_reader.NFCReader()
+    confirmer = DbConfirmer(db)
+    try:
+        asyncio.run(station_service.serve(
+            reader, lambda uid: dispense(reader, db, uid, confirmer), "station2"))
     finally:
-        conn.close()
+        confirmer.close()
+        logger.info("DB-Abgleich: %d Abweichungen, %d nicht bestätigt", confirmer.mismatches, confirmer.unconfirmed)
+        db.close()
+        reader.close()
+        logger.info("Station 2 beendet")
 
 if __name__ == "__main__":
-    main()
+    if "--metrics" in sys.argv[1:]:
+        # Enabled before the reader is created, so its PN532 commands are timed too
+        metrics.enable()
+        metrics.serve_http(METRICS_PORT)
+    if "--service" in sys.argv[1:]:
+        serve()
+    else:
+        main()
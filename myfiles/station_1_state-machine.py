@@ -1,115 +1,115 @@
+import asyncio
 import logging
+import log_pipeline
 from nfc_reader import NFCReader
+from state_machine import State, StateMachine, TIMEOUT, run_all
 
-# Configure the logger
+# Configure the logger: all records go to example.log and the console through a
+# background thread, repeated messages (e.g. while no card is present) are dropped
 logger = logging.getLogger("shared_logger")
-logging.basicConfig(filename='example.log', encoding='utf-8', level=logging.DEBUG)
-logger.setLevel(logging.DEBUG)
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
-logger.addHandler(console_handler)
+log_pipeline.attach(None, 'example.log', level=logging.DEBUG, console=True)
 
+# Seconds without a card before State1 logs that it is still waiting
+CARD_WAIT_TIMEOUT = 30.0
 
 
-class StateMachine:
-    def __init__(self):
-        self.current_state = 'State0'
+class Station1:
+    """What the states of one station 1 machine share."""
+
+    def __init__(self, pn532=None):
+        self.pn532 = pn532  # None -> real PN532 on SPI, or e.g. an EmulatedPN532
         self.reader = None
-        self.states = {
-            'State0': State0(self),
-            'State1': State1(self),
-            'State2': State2(self),
-            'State3': State3(self),
-            'State4': State4(self),
-            'State5': State5(self)
-        }
-
-    def run(self):
-        # Run the state machine until it reaches a terminal state
-        # To run indefinitely, remove the terminal states from the while loop
-        while self.current_state not in ['State4','State5']:
-            state = self.states[self.current_state]
-            state.run()  # Run the current state
-
-class State:
-    def __init__(self, machine):
-        self.machine = machine
-
-    def run(self):
-        raise NotImplementedError("State must implement 'run' method.")
-
-class State0(State):
-    def run(self):
-        logging.info("Initializing RFID reader...")
-        
-        # Simulate RFID reader initialization (replace with actual initialization code)
-        self.machine.reader = NFCReader()
-        if self.machine.reader:
-            init_successful = True  # Simulate success
-        
-        if init_successful:
-            logging.info("RFID reader initialized successfully.")
-            self.machine.current_state = 'State1'  # Transition to State1
-        else:
-            logging.error("Failed to initialize RFID reader.")
-            self.machine.current_state = 'State5'  # Transition to State5
-
-class State1(State):
-    def run(self):
-        logging.info("Waiting for RFID card...")
-        
-        # Simulate card detection (replace with actual detection code)
-        uid = [45, 162, 193, 56]  # Placeholder for RFID detection
-        uid = self.machine.reader.read_passive_target(timeout=0.5)
-        if uid is None:
-            logging.warning("No card detected. Retrying...")
-            self.machine.current_state = 'State1'  # Wait again
-        else:
-            logging.info(f"Found card with UID: {[hex(i) for i in uid]}") 
-            self.machine.current_state = 'State2'  # Transition to State2
-
-class State2(State):
-    def run(self):
-        logging.info("Writing Bottle ID to card...")
-        
-        # Simulate writing logic
-        write_successful = True  # Simulate success
-        
-        if write_successful:
-            logging.info("Successfully wrote to card.")
-            self.machine.current_state = 'State3'  # Transition to State3
-        else:
-            logging.error("Failed to write to card. Waiting for a new card.")
-            self.machine.current_state = 'State1'  # Transition back to State1
-
-class State3(State):
-    def run(self):
-        logging.info("Saving Bottle ID and timestamp to database...")
-        
-        # Simulate database write (replace with actual database code)
-        db_write_successful = True  # Simulate success
-        
-        if db_write_successful:
-            logging.info("Successfully saved to database.")
-            self.machine.current_state = 'State4'  # Transition to State4
-        else:
-            logging.error("Failed to save data to database.")
-            self.machine.current_state = 'State5'  # Transition to State5
-
-class State4(State):
-    def run(self):
-        logging.info("Successfully completed the process! Returning to State1.")
-        
-        # Transition back to State1 - probably not hepful while debugging
-        #self.machine.current_state = 'State1'  
-
-class State5(State):
-    def run(self):
-        logging.error("Process failed at some point. Please check the logs.")
-        self.machine.current_state = 'State5'  # End of process
+        self.uid = None
+
+
+async def init_reader(machine):
+    logging.info("Initializing RFID reader...")
+    try:
+        # Talks to the PN532, keep it off the event loop
+        machine.context.reader = await asyncio.to_thread(NFCReader, machine.context.pn532)
+    except Exception as e:
+        logging.error("Failed to initialize RFID reader: %s", e)
+        return "failed"
+    logging.info("RFID reader initialized successfully.")
+    return "ok"
+
+
+def waiting_for_card(machine):
+    logging.info("Waiting for RFID card...")
+
+
+async def wait_for_card(machine):
+    # The reader listens on its worker thread, the loop is free meanwhile
+    machine.context.uid = await machine.context.reader.next_card()
+    logging.info(f"Found card with UID: {[hex(i) for i in machine.context.uid]}")
+    return "card"
+
+
+def write_bottle_id(machine):
+    logging.info("Writing Bottle ID to card...")
+
+    # Simulate writing logic
+    write_successful = True  # Simulate success
+
+    if write_successful:
+        logging.info("Successfully wrote to card.")
+        return "ok"
+    logging.error("Failed to write to card. Waiting for a new card.")
+    return "failed"
+
+
+def save_bottle(machine):
+    logging.info("Saving Bottle ID and timestamp to database...")
+
+    # Simulate database write (replace with actual database code)
+    db_write_successful = True  # Simulate success
+
+    if db_write_successful:
+        logging.info("Successfully saved to database.")
+        return "ok"
+    logging.error("Failed to save data to database.")
+    return "failed"
+
+
+def done(machine):
+    # Terminal while debugging, add ("State4", ..., "State1") to keep tagging
+    logging.info("Successfully completed the process!")
+
+
+def failed(machine):
+    logging.error("Process failed at some point. Please check the logs.")
+
+
+STATES = [
+    State("State0", on_enter=init_reader),
+    State("State1", on_enter=waiting_for_card, activity=wait_for_card, timeout=CARD_WAIT_TIMEOUT),
+    State("State2", on_enter=write_bottle_id),
+    State("State3", on_enter=save_bottle),
+    State("State4", on_enter=done, terminal=True),
+    State("State5", on_enter=failed, terminal=True),
+]
+
+TRANSITIONS = [
+    ("State0", "ok", "State1"),
+    ("State0", "failed", "State5"),
+    ("State1", "card", "State2"),
+    ("State1", TIMEOUT, "State1"),
+    ("State2", "ok", "State3"),
+    ("State2", "failed", "State1"),
+    ("State3", "ok", "State4"),
+    ("State3", "failed", "State5"),
+]
+
+
+def build_machine(name="station1", pn532=None):
+    return StateMachine(name, STATES, TRANSITIONS, "State0", context=Station1(pn532))
+
 
 # Main execution
 if __name__ == '__main__':
-    machine = StateMachine()
-    machine.run()
-    logging.info("Stopped Execution. Please rerun the program to start again.")
\ No newline at end of file
+    # More stations: pass more machines, each with its own reader
+    machines = [build_machine()]
+    asyncio.run(run_all(machines))
+    for machine in machines:
+        logging.info("%s time per state: %s", machine.name, machine.dwell)
+    logging.info("Stopped Execution. Please rerun the program to start again.")
@@ -0,0 +1,120 @@
+# Long-running service loop shared by station1 and station2: the reader and the
+# DB connection are set up once and every bottle on the reader is handled in turn.
+import asyncio
+from collections import deque
+import logging
+import signal
+import statistics
+import time
+import metrics
+
+logger = logging.getLogger("station_service")
+
+CYCLE_LATENCY = metrics.histogram("station_cycle_seconds", "Duration of handling one bottle")
+CYCLES = metrics.counter("station_cycles_total", "Handled bottles", label="result")
+
+DEBOUNCE_SECONDS = 2.0
+STATS_EVERY = 100
+
+
+class CycleStats:
+    """Cycle times of the last `window` bottles, in seconds."""
+
+    def __init__(self, window=1000):
+        self.count = 0
+        self.failed = 0
+        self._times = deque(maxlen=window)
+
+    def record(self, seconds, ok=True):
+        self.count += 1
+        if not ok:
+            self.failed += 1
+        self._times.append(seconds)
+
+    def summary(self):
+        times = list(self._times)
+        if not times:
+            return {"bottles": self.count, "failed": self.failed}
+        percentiles = statistics.quantiles(times, n=100, method="inclusive") if len(times) > 1 else times * 99
+        return {
+            "bottles": self.count,
+            "failed": self.failed,
+            "mean_ms": round(statistics.fmean(times) * 1000, 1),
+            "p50_ms": round(percentiles[49] * 1000, 1),
+            "p95_ms": round(percentiles[94] * 1000, 1),
+            "max_ms": round(max(times) * 1000, 1),
+        }
+
+
+async def serve(reader, handle_card, name, debounce=DEBOUNCE_SECONDS, stats=None, max_targets=1,
+                stop=None, listen_timeout=1.0, irq=None):
+    """
+    Call `handle_card(uid)` for every card that enters the field until SIGTERM
+    or SIGINT. The handler runs on the reader's worker thread and should return
+    True on success. A UID is ignored while it stays in the field and for
+    `debounce` seconds after it was handled. A bottle that is being handled when
+    the signal arrives is finished before the service stops. With `max_targets`
+    2 every poll selects up to two bottles, which are then handled one after the other.
+    Pass an asyncio.Event as `stop` to stop the service yourself, e.g. when several
+    run in one loop; the signals are then left alone. `listen_timeout` is how long
+    one poll may wait for a card. With `irq` (the reader's IRQ input) the reader
+    only samples the pin while it waits.
+    """
+    stats = stats or CycleStats()
+    loop = asyncio.get_running_loop()
+    own_signals = stop is None
+    if own_signals:
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+
+    if max_targets > 1:
+        cards = reader.card_batches(max_targets, irq=irq, listen_timeout=listen_timeout)
+    else:
+        cards = reader.cards(irq=irq, listen_timeout=listen_timeout)
+    stopping = asyncio.ensure_future(stop.wait())
+    # UID -> when it was last handled
+    done = {}
+    logger.info("%s service running", name)
+    try:
+        while True:
+            next_card = asyncio.ensure_future(cards.__anext__())
+            await asyncio.wait({next_card, stopping}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_card.done():
+                next_card.cancel()
+                await asyncio.gather(next_card, return_exceptions=True)
+                break
+            uids = next_card.result()
+            if max_targets == 1:
+                uids = [uids]
+            now = time.perf_counter()
+            done = {uid: when for uid, when in done.items() if now - when < debounce}
+
+            for uid in uids:
+                if uid in done:
+                    continue
+                start = time.perf_counter()
+                try:
+                    ok = bool(await reader.run(handle_card, uid))
+                except Exception as e:
+                    logger.exception("%s: error handling card %s: %s", name, uid.hex(":"), e)
+                    ok = False
+                elapsed = time.perf_counter() - start
+                stats.record(elapsed, ok)
+                if metrics.is_enabled():
+                    CYCLE_LATENCY.observe(elapsed)
+                    CYCLES.inc("ok" if ok else "failed")
+                done[uid] = time.perf_counter()
+                logger.info("%s: bottle %s done in %.1f ms (ok=%s)", name, uid.hex(":"), elapsed * 1000, ok)
+                if stats.count % STATS_EVERY == 0:
+                    logger.info("%s cycle stats: %s", name, stats.summary())
+            if stop.is_set():
+                break
+    finally:
+        stopping.cancel()
+        await cards.aclose()
+        if own_signals:
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(sig)
+        logger.info("%s service stopped, cycle stats: %s", name, stats.summary())
+    return stats
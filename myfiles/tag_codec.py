@@ -0,0 +1,168 @@
+# Bottle tag payload shared by station 1 (writes it) and station 2 (reads it).
+# Layout version 1, little endian, starting at block 4 and skipping sector trailers:
+#
+#   0   magic  b"FLSH"
+#   4   format version (1)
+#   5   number of dosing entries n
+#   6   Flaschen_ID   uint32
+#   10  Rezept_ID     uint16
+#   12  n x (Granulat_ID uint16, Menge in tenths uint16)
+#   ..  CRC-32 of everything before it, uint32
+#
+# Up to 8 entries fit in sector 1 (blocks 4-6), up to 20 with sector 2.
+# Tags written before the codec (b"AHTS"/b"BOTL" + Flaschen_ID) still decode,
+# they only carry the Flaschen_ID.
+from collections import namedtuple
+import struct
+import zlib
+
+from nfc_reader import BLOCK_SIZE, BLOCKS_PER_SECTOR, is_sector_trailer
+
+MAGIC = b"FLSH"
+VERSION = 1
+LEGACY_MAGICS = (b"AHTS", b"BOTL")
+MENGE_SCALE = 10
+
+PAYLOAD_SECTORS = (1, 2)
+PAYLOAD_BLOCKS = tuple(
+    block_number
+    for sector in PAYLOAD_SECTORS
+    for block_number in range(sector * BLOCKS_PER_SECTOR, (sector + 1) * BLOCKS_PER_SECTOR)
+    if not is_sector_trailer(block_number)
+)
+HEADER_BLOCK = PAYLOAD_BLOCKS[0]
+# Blocks read together with the header, enough for recipes with up to 4 Granulate
+READ_AHEAD = 2
+
+_HEADER = struct.Struct("<4sBBIH")
+_ENTRY = struct.Struct("<HH")
+_CRC = struct.Struct("<I")
+MAX_ENTRIES = (len(PAYLOAD_BLOCKS) * BLOCK_SIZE - _HEADER.size - _CRC.size) // _ENTRY.size
+
+# mengen: tuple of (Granulat_ID, Menge) like RecipeCatalog.mengen(); version 0 are legacy tags
+TagPayload = namedtuple("TagPayload", ["flaschen_id", "rezept_id", "mengen", "version"])
+
+
+class TagPayloadError(ValueError):
+    pass
+
+
+def quantize(mengen):
+    """Mengen as they come back from a tag, to compare them with the DB."""
+    return tuple((granulat_id, round(menge * MENGE_SCALE) / MENGE_SCALE) for granulat_id, menge in mengen)
+
+
+def _size(count):
+    return _HEADER.size + count * _ENTRY.size + _CRC.size
+
+
+def encode(flaschen_id, rezept_id, mengen):
+    """Payload bytes, padded to whole blocks. Mengen are stored rounded to 1/MENGE_SCALE."""
+    if len(mengen) > MAX_ENTRIES:
+        raise ValueError(f"{len(mengen)} dosing entries do not fit on a tag (max {MAX_ENTRIES})")
+    size = _size(len(mengen))
+    buffer = bytearray(-(-size // BLOCK_SIZE) * BLOCK_SIZE)
+    try:
+        _HEADER.pack_into(buffer, 0, MAGIC, VERSION, len(mengen), flaschen_id, rezept_id)
+        offset = _HEADER.size
+        for granulat_id, menge in mengen:
+            _ENTRY.pack_into(buffer, offset, granulat_id, round(menge * MENGE_SCALE))
+            offset += _ENTRY.size
+    except struct.error as e:
+        raise ValueError(f"Value out of range for the tag layout: {e}") from e
+    _CRC.pack_into(buffer, offset, zlib.crc32(memoryview(buffer)[:offset]))
+    return bytes(buffer)
+
+
+def to_blocks(payload):
+    """{block_number: 16 bytes} for NFCReader.write_blocks()."""
+    return {
+        block_number: payload[index * BLOCK_SIZE:(index + 1) * BLOCK_SIZE]
+        for index, block_number in enumerate(PAYLOAD_BLOCKS[:len(payload) // BLOCK_SIZE])
+    }
+
+
+def payload_size(header):
+    """Bytes of payload announced by the header block, None if the tag carries none."""
+    view = memoryview(header)
+    if len(view) < BLOCK_SIZE:
+        return None
+    magic = view[:4]
+    if magic in LEGACY_MAGICS:
+        return BLOCK_SIZE
+    if magic != MAGIC:
+        return None
+    count = view[5]
+    if count > MAX_ENTRIES:
+        raise TagPayloadError(f"Header announces {count} dosing entries (max {MAX_ENTRIES})")
+    return _size(count)
+
+
+def peek_flaschen_id(header):
+    """Flaschen_ID from the header block alone, without checking the rest of the payload."""
+    if payload_size(header) is None:
+        return None
+    view = memoryview(header)
+    if view[:4] == MAGIC:
+        return _HEADER.unpack_from(view)[3]
+    return int.from_bytes(view[4:8], "little") or None
+
+
+def decode(buffer):
+    """
+    Decode a payload from any buffer (bytes, bytearray, memoryview of a card dump)
+    without copying it. Returns None if it carries no payload, raises
+    TagPayloadError if it is truncated, corrupted or of an unknown version.
+    """
+    view = memoryview(buffer)
+    size = payload_size(view)
+    if size is None:
+        return None
+    if view[:4] != MAGIC:
+        flaschen_id = int.from_bytes(view[4:8], "little")
+        return TagPayload(flaschen_id, None, (), 0) if flaschen_id else None
+    if len(view) < size:
+        raise TagPayloadError(f"Payload truncated: {len(view)} of {size} bytes")
+
+    magic, version, count, flaschen_id, rezept_id = _HEADER.unpack_from(view)
+    if version != VERSION:
+        raise TagPayloadError(f"Unknown tag format version {version}")
+    end = size - _CRC.size
+    if zlib.crc32(view[:end]) != _CRC.unpack_from(view, end)[0]:
+        raise TagPayloadError(f"Checksum mismatch for Flaschen_ID {flaschen_id}")
+    mengen = tuple(
+        (granulat_id, menge / MENGE_SCALE)
+        for granulat_id, menge in _ENTRY.iter_unpack(view[_HEADER.size:end])
+    )
+    return TagPayload(flaschen_id, rezept_id, mengen, version)
+
+
+def read(reader, uid):
+    """
+    Read and decode the payload of a card, one authentication per sector.
+    None for a card without payload.
+    """
+    blocks = reader.read_blocks(uid, PAYLOAD_BLOCKS[:READ_AHEAD])
+    if blocks[HEADER_BLOCK] is None:
+        raise TagPayloadError(f"Block {HEADER_BLOCK} could not be read")
+    size = payload_size(blocks[HEADER_BLOCK])
+    if size is None:
+        return None
+    needed = PAYLOAD_BLOCKS[:-(-size // BLOCK_SIZE)]
+    missing = [block_number for block_number in needed if block_number not in blocks]
+    if missing:
+        blocks.update(reader.read_blocks(uid, missing))
+
+    data = bytearray()
+    for block_number in needed:
+        if blocks[block_number] is None:
+            raise TagPayloadError(f"Block {block_number} could not be read")
+        data += blocks[block_number]
+    return decode(data)
+
+
+def write(reader, uid, payload):
+    """Write an encoded payload to the card. True if every block was written."""
+    results = reader.write_blocks(uid, to_blocks(payload))
+    return bool(results) and all(results.values())
+
@@ -0,0 +1,139 @@
+# Non-blocking file logging. The calling thread only puts records on a queue; one
+# QueueListener thread per log file formats and writes them, with size-based
+# rotation, optional JSON lines and suppression of repeated messages below ERROR.
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+DEFAULT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+MAX_BYTES = 5 * 1024 * 1024
+BACKUP_COUNT = 3
+RATE_LIMIT_INTERVAL = 30.0
+MAX_RATE_LIMIT_KEYS = 1024
+# Only repeats up to this level are dropped, every ERROR and CRITICAL record is kept
+RATE_LIMIT_MAX_LEVEL = logging.WARNING
+
+_lock = threading.Lock()
+_pipelines = {}
+
+
+class LineFormatter(logging.Formatter):
+    """Plain text lines; a record that follows suppressed repeats says how many there were."""
+
+    def format(self, record):
+        line = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            line += " (%d repeats suppressed)" % suppressed
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets the first of a series of identical messages (same logger, level and text)
+    through and drops the repeats for `interval` seconds. The next one let through
+    carries the number of dropped repeats in `record.suppressed`. Records above
+    `max_level` always pass.
+    """
+
+    def __init__(self, interval=RATE_LIMIT_INTERVAL, max_keys=MAX_RATE_LIMIT_KEYS, max_level=RATE_LIMIT_MAX_LEVEL):
+        super().__init__()
+        self.interval = interval
+        self.max_keys = max_keys
+        self.max_level = max_level
+        self.suppressed_total = 0
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+        key = (record.name, record.levelno, record.getMessage())
+        now = time.monotonic()
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry is not None and now - entry[0] < self.interval:
+                entry[1] += 1
+                self.suppressed_total += 1
+                return False
+            if entry is None and len(self._seen) >= self.max_keys:
+                self._seen.clear()
+            self._seen[key] = [now, 0]
+        record.suppressed = entry[1] if entry is not None else 0
+        return True
+
+
+def attach(logger, filepath, level=logging.DEBUG, fmt=DEFAULT_FORMAT, datefmt=None, json_format=False,
+           rate_limit=RATE_LIMIT_INTERVAL, console=False, max_bytes=MAX_BYTES, backup_count=BACKUP_COUNT):
+    """
+    Send the records of `logger` (a Logger or a name, None for the root logger) to
+    `filepath` through a queue. The file is opened once by the listener thread and
+    rotated after `max_bytes`; with `console` the listener also writes to stderr.
+    `rate_limit` is the dedup interval in seconds for records up to WARNING, 0
+    turns it off. Attaching the same logger and file again returns the existing
+    QueueHandler.
+    """
+    if not isinstance(logger, logging.Logger):
+        logger = logging.getLogger(logger)
+    key = (logger.name, os.path.abspath(filepath))
+    with _lock:
+        if key in _pipelines:
+            return _pipelines[key][0]
+
+        formatter = JsonFormatter(datefmt=datefmt) if json_format else LineFormatter(fmt, datefmt)
+        handlers = [logging.handlers.RotatingFileHandler(
+            filepath, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)]
+        if console:
+            handlers.append(logging.StreamHandler())
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        records = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        queue_handler = logging.handlers.QueueHandler(records)
+        queue_handler.setLevel(level)
+        if rate_limit:
+            queue_handler.addFilter(RateLimitFilter(rate_limit))
+
+        listener.start()
+        logger.addHandler(queue_handler)
+        if logger.getEffectiveLevel() > level:
+            logger.setLevel(level)
+        _pipelines[key] = (queue_handler, listener, logger)
+        return queue_handler
+
+
+def shutdown():
+    """Write out everything still queued and close the files. Runs at exit."""
+    with _lock:
+        pipelines = list(_pipelines.values())
+        _pipelines.clear()
+    for queue_handler, listener, logger in pipelines:
+        logger.removeHandler(queue_handler)
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+atexit.register(shutdown)
@@ -1,10 +1,22 @@
 # Example how to build a NFCReader that implements an Interface
 from abc import ABC, abstractmethod
-import board
-import busio
-from digitalio import DigitalInOut
-from adafruit_pn532.spi import PN532_SPI
+from collections import Counter, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import time
 import logging
+import log_pipeline
+import metrics
+
+try:
+    import board
+    import busio
+    from digitalio import DigitalInOut
+    from adafruit_pn532.spi import PN532_SPI
+except (ImportError, NotImplementedError):
+    # No Blinka/PN532 stack on this machine, only emulated readers can be used
+    board = busio = DigitalInOut = PN532_SPI = None
 
 
 # Configure logging
@@ -12,21 +24,318 @@ logger = logging.getLogger("shared_logger")
 
 # Constants
 DEFAULT_KEY_A = bytes([0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF])
+DEFAULT_CS_PIN = "D8"
 BLOCK_COUNT = 64
+BLOCK_SIZE = 16
+BLOCKS_PER_SECTOR = 4
+SECTOR_COUNT = BLOCK_COUNT // BLOCKS_PER_SECTOR
+# Raised by the driver on a missing ACK, a bad checksum or an SPI error; polling goes on after them
+TRANSIENT_ERRORS = (RuntimeError, OSError)
+# Seconds to wait after a failed poll, doubled for every further failure in a row
+POLL_BACKOFF = 0.05
+POLL_BACKOFF_MAX = 2.0
+# InListPassiveTarget selects at most two targets at once
+MAX_TARGETS = 2
+MAX_UID_LENGTH = 10
+
+# PN532 commands and MIFARE Classic opcodes sent by the target-number API
+_COMMAND_INDATAEXCHANGE = 0x40
+_COMMAND_INLISTPASSIVETARGET = 0x4A
+_MIFARE_ISO14443A = 0x00
+MIFARE_CMD_AUTH_A = 0x60
+MIFARE_CMD_READ = 0x30
+MIFARE_CMD_WRITE = 0xA0
+# SEL_RES bit of targets that follow ISO/IEC 14443-4, their entry carries an ATS
+_SEL_RES_ISO14443_4 = 0x20
+
+# Result of a sector-aware full card read: the CardImage and the read time of every sector
+CardDump = namedtuple("CardDump", ["image", "sector_times"])
+
+# One card selected by InListPassiveTarget. `number` is the PN532 target number
+# (Tg, 1 or 2) that InDataExchange addresses it by until the next selection.
+Target = namedtuple("Target", ["number", "uid", "sens_res", "sel_res"])
+
+
+def sector_of(block_number):
+    return block_number // BLOCKS_PER_SECTOR
+
+
+def sector_first_block(sector):
+    return sector * BLOCKS_PER_SECTOR
+
+
+def is_sector_trailer(block_number):
+    return block_number % BLOCKS_PER_SECTOR == BLOCKS_PER_SECTOR - 1
+
+
+_BLOCK_MASK = (1 << BLOCK_SIZE * 8) - 1
+
+
+class CardImage:
+    """
+    A whole MIFARE Classic 1K card in one BLOCK_COUNT * BLOCK_SIZE bytearray;
+    block n lives at data[n * BLOCK_SIZE:(n + 1) * BLOCK_SIZE]. Bit n of `valid`
+    is set once block n was read, blocks that were skipped or could not be read
+    stay zero-filled. block() and sector() return memoryviews into `data`, they
+    copy nothing and see later changes.
+    """
+
+    __slots__ = ("data", "valid")
+
+    def __init__(self, data=None, valid=0):
+        if data is None:
+            data = bytearray(BLOCK_COUNT * BLOCK_SIZE)
+        elif len(data) != BLOCK_COUNT * BLOCK_SIZE:
+            raise ValueError(f"A card image has {BLOCK_COUNT * BLOCK_SIZE} bytes, got {len(data)}")
+        self.data = bytearray(data)
+        self.valid = valid
+
+    def set_block(self, block_number, block_data):
+        if len(block_data) != BLOCK_SIZE:
+            raise ValueError(f"Block {block_number} must be {BLOCK_SIZE} bytes, got {len(block_data)}")
+        start = block_number * BLOCK_SIZE
+        self.data[start:start + BLOCK_SIZE] = block_data
+        self.valid |= 1 << block_number
+
+    def is_valid(self, block_number):
+        return bool(self.valid >> block_number & 1)
+
+    @property
+    def missing(self):
+        """Numbers of the blocks that were not read."""
+        return [block_number for block_number in range(BLOCK_COUNT) if not self.valid >> block_number & 1]
+
+    def block(self, block_number):
+        start = block_number * BLOCK_SIZE
+        return memoryview(self.data)[start:start + BLOCK_SIZE]
+
+    def sector(self, sector):
+        start = sector_first_block(sector) * BLOCK_SIZE
+        return memoryview(self.data)[start:start + BLOCKS_PER_SECTOR * BLOCK_SIZE]
+
+    def blocks(self):
+        """(block number, memoryview) of every valid block."""
+        return ((block_number, self.block(block_number))
+                for block_number in range(BLOCK_COUNT) if self.valid >> block_number & 1)
+
+    def hex(self, block_number, sep=" "):
+        """Bytes of a block as hex, e.g. '93 5f a7 91 ...'."""
+        return self.block(block_number).hex(sep)
+
+    def diff(self, other):
+        """Numbers of the blocks that differ, in content or because only one of the images has them."""
+        if self.valid == other.valid and self.data == other.data:
+            return []
+        # One XOR over the whole card as a big integer, then BLOCK_SIZE bytes at a time
+        # from the low end; the loop ends after the last block that differs
+        differing = 0
+        xor = int.from_bytes(self.data, "little") ^ int.from_bytes(other.data, "little")
+        block_number = 0
+        while xor:
+            if xor & _BLOCK_MASK:
+                differing |= 1 << block_number
+            xor >>= BLOCK_SIZE * 8
+            block_number += 1
+        changed = (self.valid ^ other.valid) | (differing & self.valid & other.valid)
+        return [block_number for block_number in range(BLOCK_COUNT) if changed >> block_number & 1]
+
+    def copy(self):
+        return CardImage(self.data, self.valid)
+
+    def __eq__(self, other):
+        if not isinstance(other, CardImage):
+            return NotImplemented
+        return self.valid == other.valid and self.data == other.data
+
+    def __repr__(self):
+        return "CardImage(%d of %d blocks)" % (bin(self.valid).count("1"), BLOCK_COUNT)
+
+
+def parse_targets(response):
+    """Targets listed in an InListPassiveTarget response (106 kbps type A), [] for None."""
+    if not response:
+        return []
+    targets = []
+    offset = 1
+    for _ in range(response[0]):
+        if len(response) < offset + 5:
+            raise RuntimeError("Truncated InListPassiveTarget response")
+        number, sens_high, sens_low, sel_res, uid_length = response[offset:offset + 5]
+        if uid_length > MAX_UID_LENGTH:
+            raise RuntimeError("Found card with unexpectedly long UID!")
+        offset += 5
+        uid = bytes(response[offset:offset + uid_length])
+        offset += uid_length
+        if sel_res & _SEL_RES_ISO14443_4:
+            # The ATS length byte counts itself
+            offset += response[offset]
+        targets.append(Target(number, uid, bytes([sens_high, sens_low]), sel_res))
+    return targets
+
+
+class BlockCache:
+    """
+    Per-UID cache of block contents. Only blocks of the most recently selected
+    UID are kept; selecting another UID or losing the card clears the cache.
+    Entries expire after `ttl` seconds and at most `max_blocks` are kept.
+    """
+
+    def __init__(self, max_blocks=BLOCK_COUNT, ttl=5.0):
+        self.max_blocks = max_blocks
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._uid = None
+        self._blocks = OrderedDict()
+
+    def select(self, uid):
+        uid = None if uid is None else bytes(uid)
+        if uid != self._uid:
+            self._blocks.clear()
+            self._uid = uid
+
+    def invalidate(self):
+        self.select(None)
+
+    def get(self, uid, block_number):
+        if self._uid is None or bytes(uid) != self._uid:
+            self.misses += 1
+            return None
+        entry = self._blocks.get(block_number)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            self._blocks.pop(block_number, None)
+            self.misses += 1
+            return None
+        self._blocks.move_to_end(block_number)
+        self.hits += 1
+        return bytearray(entry[0])
+
+    def put(self, uid, block_number, data):
+        self.select(uid)
+        self._blocks[block_number] = (bytes(data), time.monotonic())
+        self._blocks.move_to_end(block_number)
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "blocks": len(self._blocks)}
+
+
+PN532_LATENCY = {
+    name: metrics.histogram(f"pn532_{metric}_seconds", f"Duration of PN532 {name} calls")
+    for name, metric in (
+        ("read_passive_target", "read_passive_target"),
+        ("get_passive_target", "get_passive_target"),
+        ("mifare_classic_authenticate_block", "authenticate"),
+        ("mifare_classic_read_block", "read_block"),
+        ("mifare_classic_write_block", "write_block"),
+    )
+}
+# Calls whose result means failure: authentication and writes return False, reads None
+PN532_FAILURES = metrics.counter("pn532_failures_total", "Failed PN532 commands", label="command")
+RETRIES = metrics.counter("nfc_retries_total", "Repeated PN532 commands", label="reason")
+GAVE_UP = metrics.counter("nfc_gave_up_total", "Operations given up after failures", label="reason")
+POLL_ERRORS = metrics.counter("nfc_poll_errors_total", "Polls for cards that failed in the driver", label="error")
+_FAILED_RESULT = {
+    "mifare_classic_authenticate_block": False,
+    "mifare_classic_read_block": None,
+    "mifare_classic_write_block": False,
+}
+
+
+class InstrumentedPN532:
+    """
+    Proxy around a PN532 that records the latency of the hot-path commands and
+    counts failed ones. NFCReader puts it in place when metrics are enabled.
+    """
+
+    def __init__(self, pn532):
+        self._pn532 = pn532
+
+    def __getattr__(self, name):
+        value = getattr(self._pn532, name)
+        histogram = PN532_LATENCY.get(name)
+        if histogram is None:
+            return value
+
+        def command(*args, **kwargs):
+            if not metrics.is_enabled():
+                return value(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                result = value(*args, **kwargs)
+            except Exception:
+                PN532_FAILURES.inc(name)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start)
+            if name in _FAILED_RESULT and result is _FAILED_RESULT[name]:
+                PN532_FAILURES.inc(name)
+            return result
+        return command
+
+
+class RetryPolicy:
+    """
+    How NFCReader repeats a failed authentication, read or write. `attempts`
+    includes the first try; the pause before retry n is delay * backoff**(n-1),
+    capped at `max_delay`, and no retry starts once `deadline` seconds would be
+    exceeded. Before every retry the tag is selected again: a card drops out of
+    its selected state after an error, and a tag that left the field is not
+    retried at all.
+    """
+
+    def __init__(self, attempts=3, delay=0.005, backoff=2.0, max_delay=0.05, deadline=0.25,
+                 reselect_timeout=0.05):
+        self.attempts = attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.reselect_timeout = reselect_timeout
+
+    def pause(self, retry):
+        return min(self.delay * self.backoff ** (retry - 1), self.max_delay)
+
+
+NO_RETRY = RetryPolicy(attempts=1)
+
+
+class CommandFailed(Exception):
+    """
+    A PN532 command failed. `reason` is "auth", "read", "write" or "transient"
+    (garbled frame, the driver raised), or "tag_left" once a re-select did not
+    find the tag anymore.
+    """
+
+    def __init__(self, reason, detail=""):
+        super().__init__(f"{reason}: {detail}" if detail else reason)
+        self.reason = reason
 
 
 class NFCReaderInterface(ABC):
 
     @abstractmethod
-    def config(self):
+    def config(self, pn532=None):
         pass
     @abstractmethod
     def add_logger(self, filepath : str):
         pass
     @abstractmethod
+    def list_targets(self, max_targets : int = MAX_TARGETS, timeout : float = 1.0):
+        pass
+    @abstractmethod
     def read_block(self, uid : bytes , block_number : int):
         pass
 
+    @abstractmethod
+    def read_sector(self, uid : bytes, sector : int, skip_trailer : bool = False):
+        pass
+
+    @abstractmethod
+    def read_blocks(self, uid : bytes, block_numbers : list):
+        pass
+
     @abstractmethod
     def read_all_blocks(self, uid : int):
         pass
@@ -35,117 +344,564 @@ class NFCReaderInterface(ABC):
     def write_block(self, uid : bytes, block_number : int, data : bytes):
         pass
 
+    @abstractmethod
+    def write_blocks(self, uid : bytes, blocks : dict, verify : bool = False):
+        pass
+
 
 class NFCReader(NFCReaderInterface):
-    def __init__(self):
-        self._pn532 = self.config()
+    def __init__(self, pn532=None, cache=None, cs_pin=DEFAULT_CS_PIN, retry=None):
+        """
+        Without arguments the PN532 on the SPI bus with chip select `cs_pin` (a
+        `board` pin name) is used. Pass any object with the PN532_SPI API (e.g.
+        pn532_emulator.EmulatedPN532 or one attached to a reader_manager.SPIBusArbiter) to use
+        that instead. Pass a BlockCache to serve repeated reads of the card in the
+        field from memory. `retry` is the RetryPolicy for tag commands
+        (NO_RETRY to fail on the first error).
+        """
+        self._cache = cache
+        # UID -> target number of the cards selected by the last list_targets()
+        self._targets = {}
+        self._retry = retry or RetryPolicy()
+        # By reason, also exported as metrics when they are enabled
+        self.retry_counts = Counter()
+        self.gave_up_counts = Counter()
+        # By exception type, for polls that failed in the driver (missing ACK, checksum, SPI)
+        self.poll_error_counts = Counter()
+        # Polls for cards and the cards they reported, from the async API or a ReaderManager
+        self.polls = 0
+        self.cards_found = 0
+        self._cs_pin = cs_pin
+        self._executor = None
+        self._pn532 = self.config(pn532)
 
     def __getattr__(self, name):
         """
         Delegate any call to PN532_SPI if it's not explicitly defined in NFCReader.
         """
         return getattr(self._pn532, name)
-    # TODO: add logging config
-    def add_logger(self, filepath : str):
-        pass
-    def config(self):
+    def add_logger(self, filepath : str, json_format : bool = False):
+        """
+        Also write the reader's log to `filepath`. Records are queued and written
+        by a background thread, so reading and writing tags never waits for the file.
+        """
+        return log_pipeline.attach(logger, filepath, json_format=json_format)
+    def config(self, pn532=None):
         try:
-            spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
-            cs_pin = DigitalInOut(board.D8)
-            pn532 = PN532_SPI(spi, cs_pin, debug=False)
+            if pn532 is None:
+                if PN532_SPI is None:
+                    raise RuntimeError("adafruit-blinka/adafruit-pn532 are not available")
+                spi = busio.SPI(board.SCK, board.MOSI, board.MISO)
+                cs_pin = DigitalInOut(getattr(board, self._cs_pin))
+                pn532 = PN532_SPI(spi, cs_pin, debug=False)
 
             ic, ver, rev, support = pn532.firmware_version
             logger.info("Found PN532 with firmware version: %d.%d", ver, rev)
 
             # Configure PN532 to communicate with MiFare cards
             pn532.SAM_configuration()
+            if metrics.is_enabled():
+                pn532 = InstrumentedPN532(pn532)
             return pn532
         except Exception as e:
             logger.error("Failed to configure PN532: %s", e)
             raise
 
+    @property
+    def cache(self):
+        return self._cache
+
+    def read_passive_target(self, *args, **kwargs):
+        uid = self._pn532.read_passive_target(*args, **kwargs)
+        # Selecting a single card releases every other target
+        self._targets = {}
+        if self._cache is not None:
+            # No card means the tag left the field, a new UID means a new tag
+            self._cache.select(uid)
+        return uid
+
+    def get_passive_target(self, *args, **kwargs):
+        uid = self._pn532.get_passive_target(*args, **kwargs)
+        self._targets = {}
+        if self._cache is not None:
+            self._cache.select(uid)
+        return uid
+
+    # Multiple targets. After list_targets() the UIDs it returned work with every
+    # UID-based method, the commands are then sent to the card's target number.
+
+    def list_targets(self, max_targets=MAX_TARGETS, timeout=1.0):
+        """
+        Select up to `max_targets` cards in the field with one InListPassiveTarget
+        and return them as Targets in target number order, [] if no card answered
+        within `timeout`. Every call releases the targets of the previous one, the
+        same card may get a different target number.
+        """
+        response = self._pn532.call_function(
+            _COMMAND_INLISTPASSIVETARGET,
+            params=[max_targets, _MIFARE_ISO14443A],
+            response_length=64,
+            timeout=timeout,
+        )
+        return self._select_targets(response)
+
+    def listen_for_targets(self, max_targets=MAX_TARGETS, timeout=1.0):
+        """
+        Send InListPassiveTarget for up to `max_targets` cards without waiting for
+        them, like listen_for_passive_target(). True if the PN532 acknowledged it;
+        get_targets() then fetches the cards once the IRQ pin is low.
+        """
+        return self._pn532.send_command(
+            _COMMAND_INLISTPASSIVETARGET, params=[max_targets, _MIFARE_ISO14443A], timeout=timeout)
+
+    def get_targets(self, timeout=1.0):
+        """The Targets answering the last listen_for_targets(), [] if none did within `timeout`."""
+        response = self._pn532.process_response(_COMMAND_INLISTPASSIVETARGET, response_length=64, timeout=timeout)
+        return self._select_targets(response)
+
+    def _select_targets(self, response):
+        targets = parse_targets(response)
+        self._targets = {target.uid: target.number for target in targets}
+        if self._cache is not None:
+            # The cache only follows a single card
+            self._cache.select(targets[0].uid if len(targets) == 1 else None)
+        return targets
+
+    def _data_exchange(self, command, params, response_length=1):
+        # InDataExchange answers with a status byte, 0x00 on success, then the data
+        with PN532_LATENCY[command].time():
+            response = self._pn532.call_function(
+                _COMMAND_INDATAEXCHANGE, params=params, response_length=response_length)
+        if response is None or len(response) < response_length or response[0] != 0x00:
+            PN532_FAILURES.inc(command)
+            return None
+        return response
+
+    def authenticate_target(self, number, uid, block_number, key=DEFAULT_KEY_A, key_number=MIFARE_CMD_AUTH_A):
+        """Authenticate the sector of `block_number` on target `number`. True on success."""
+        params = bytes([number, key_number & 0xFF, block_number & 0xFF]) + bytes(key) + bytes(uid)
+        return self._data_exchange("mifare_classic_authenticate_block", params) is not None
+
+    def read_target_block(self, number, block_number):
+        """One block of the authenticated sector of target `number`, None on failure."""
+        response = self._data_exchange(
+            "mifare_classic_read_block", bytes([number, MIFARE_CMD_READ, block_number & 0xFF]), 17)
+        return None if response is None else response[1:]
+
+    def write_target_block(self, number, block_number, data):
+        """Write 16 bytes to a block of the authenticated sector of target `number`."""
+        assert data is not None and len(data) == BLOCK_SIZE, "Data must be an array of 16 bytes!"
+        params = bytes([number, MIFARE_CMD_WRITE, block_number & 0xFF]) + bytes(data)
+        return self._data_exchange("mifare_classic_write_block", params) is not None
+
+    def _auth_command(self, uid, block_number):
+        number = self._targets.get(bytes(uid))
+        if number is None:
+            return self._pn532.mifare_classic_authenticate_block(uid, block_number, MIFARE_CMD_AUTH_A, key=DEFAULT_KEY_A)
+        return self.authenticate_target(number, uid, block_number)
+
+    def _read_command(self, uid, block_number):
+        number = self._targets.get(bytes(uid))
+        if number is None:
+            return self._pn532.mifare_classic_read_block(block_number)
+        return self.read_target_block(number, block_number)
+
+    def _write_command(self, uid, block_number, data):
+        number = self._targets.get(bytes(uid))
+        if number is None:
+            return self._pn532.mifare_classic_write_block(block_number, data)
+        return self.write_target_block(number, block_number, data)
+
     def read_block(self, uid, block_number):
+        if self._cache is not None:
+            block_data = self._cache.get(uid, block_number)
+            if block_data is not None:
+                return block_data
         try:
-            authenticated = self._pn532.mifare_classic_authenticate_block(
-                uid, block_number, 0x60, key=DEFAULT_KEY_A
-            )
-            if not authenticated:
-                logger.error("Failed to authenticate block %d", block_number)
-                return None
+            block_data = self._attempt(uid, self._read_block_once, uid, block_number)
+        except CommandFailed as e:
+            logger.error("Failed to read block %d (%s)", block_number, e)
+            return None
+        if self._cache is not None:
+            self._cache.put(uid, block_number, block_data)
+        return block_data
 
-            block_data = self._pn532.mifare_classic_read_block(block_number)
-            if block_data is None:
-                logger.error("Failed to read block %d", block_number)
-                return None
+    def _read_block_once(self, uid, block_number):
+        self._authenticate(uid, block_number)
+        block_data = self._read_command(uid, block_number)
+        if block_data is None:
+            raise CommandFailed("read", f"block {block_number}")
+        return block_data
+
+    # Retry handling
+
+    def _authenticate(self, uid, block_number):
+        if not self._auth_command(uid, block_number):
+            raise CommandFailed("auth", f"block {block_number}")
 
-            return block_data
+    def _reselect(self, uid):
+        """Select the tag again after an error. False if it is no longer in the field."""
+        uid = bytes(uid)
+        try:
+            if uid in self._targets:
+                # Listing again keeps the other target selected too
+                return any(target.uid == uid for target in self.list_targets(
+                    max_targets=len(self._targets), timeout=self._retry.reselect_timeout))
+            found = self.read_passive_target(timeout=self._retry.reselect_timeout)
         except Exception as e:
-            logger.exception("Error reading block %d: %s", block_number, e)
-            return None
+            # Can't tell, the next attempt will show
+            logger.debug("Re-selecting the tag failed: %s", e)
+            return True
+        return found is not None and bytes(found) == uid
 
-    def read_all_blocks(self, uid):
-        blocks_data = []
-        for block_number in range(BLOCK_COUNT):
-            block_data = self.read_block(uid, block_number)
-            if block_data:
-                blocks_data.append(block_data)
-            else:
-                logger.warning("No data read from Block %d", block_number)
-        return blocks_data
+    def _attempt(self, uid, operation, *args):
+        """
+        Run `operation(*args)` under the retry policy. The operation raises
+        CommandFailed (or the driver's exception) on failure and must be safe to
+        repeat. Raises CommandFailed with the last reason when giving up.
+        """
+        policy = self._retry
+        start = time.monotonic()
+        retry = 0
+        while True:
+            try:
+                return operation(*args)
+            except CommandFailed as e:
+                failure = e
+            except Exception as e:
+                # The driver raises RuntimeError on garbled frames and missing ACKs
+                failure = CommandFailed("transient", str(e))
+            retry += 1
+            pause = policy.pause(retry)
+            if retry >= policy.attempts or time.monotonic() - start + pause > policy.deadline:
+                self.gave_up_counts[failure.reason] += 1
+                GAVE_UP.inc(failure.reason)
+                raise failure
+            self.retry_counts[failure.reason] += 1
+            RETRIES.inc(failure.reason)
+            logger.debug("Retrying after %s (retry %d)", failure, retry)
+            time.sleep(pause)
+            if not self._reselect(uid):
+                self.gave_up_counts["tag_left"] += 1
+                GAVE_UP.inc("tag_left")
+                raise CommandFailed("tag_left", str(failure))
 
-    def write_block(self, uid, block_number, data):
+    def read_sector(self, uid, sector, skip_trailer=False):
+        """
+        Read all blocks of one sector with a single authentication.
+        Returns a list with one entry per block of the sector, None for blocks
+        that were skipped or could not be read.
+        """
+        first = sector_first_block(sector)
+        block_numbers = [
+            first + offset for offset in range(BLOCKS_PER_SECTOR)
+            if not (skip_trailer and is_sector_trailer(first + offset))
+        ]
+        blocks = self.read_blocks(uid, block_numbers)
+        return [blocks.get(first + offset) for offset in range(BLOCKS_PER_SECTOR)]
+
+    def read_blocks(self, uid, block_numbers):
+        """
+        Read the given blocks with one authentication per sector, blocks in the
+        cache are not read again. Returns a dict of block number -> data in the
+        given order, None for blocks that could not be read.
+        """
+        results = dict.fromkeys(block_numbers)
+        by_sector = OrderedDict()
+        for block_number in block_numbers:
+            if self._cache is not None:
+                results[block_number] = self._cache.get(uid, block_number)
+            if results[block_number] is None:
+                by_sector.setdefault(sector_of(block_number), []).append(block_number)
+
+        for sector, numbers in by_sector.items():
+            self._read_sector_blocks(uid, sector, numbers, results)
+        return results
+
+    def _read_sector_blocks(self, uid, sector, block_numbers, results):
         try:
-            # Validate `uid` type
-            if not isinstance(uid, bytes):
-                logger.error("UID must be of type 'bytes'. Provided type: %s", type(uid))
-                return False
+            self._attempt(uid, self._read_sector_once, uid, sector, block_numbers, results)
+        except CommandFailed as e:
+            logger.error("Failed to read sector %d (%s)", sector, e)
 
-            # Validate `data` type and length
-            if not isinstance(data, bytes) or len(data) != 16:
-                logger.error(
-                    "Data must be a 'bytes' object of exactly 16 bytes. Provided: type=%s, length=%d",
-                    type(data),
-                    len(data) if isinstance(data, bytes) else 0,
-                )
-                return False
-        
-            authenticated = self._pn532.mifare_classic_authenticate_block(
-                uid, block_number, 0x60, key=DEFAULT_KEY_A
-            )
-            if not authenticated:
-                logger.error("Failed to authenticate block %d for writing", block_number)
-                return False
+    def _read_sector_once(self, uid, sector, block_numbers, results):
+        self._authenticate(uid, sector_first_block(sector))
+        self._read_authenticated(uid, block_numbers, results)
 
-            success = self._pn532.mifare_classic_write_block(block_number, data)
-            if not success:
-                logger.error("Failed to write to block %d", block_number)
-                return False
+    def _read_authenticated(self, uid, block_numbers, results):
+        # Blocks read by an earlier attempt are kept, a retry reads only the rest
+        for block_number in block_numbers:
+            if results[block_number] is not None:
+                continue
+            block_data = self._read_command(uid, block_number)
+            if block_data is None:
+                raise CommandFailed("read", f"block {block_number}")
+            results[block_number] = block_data
+            if self._cache is not None:
+                self._cache.put(uid, block_number, block_data)
 
-            logger.info("Successfully wrote data to block %d", block_number)
-            return True
-        except Exception as e:
-            logger.exception("Error writing block %d: %s", block_number, e)
+    def read_card(self, uid, skip_trailers=False):
+        """
+        Dump the whole card sector by sector, authenticating once per sector.
+        Returns a CardDump with the CardImage and the read time of every sector
+        in seconds.
+        """
+        image = CardImage()
+        sector_times = []
+        for sector in range(SECTOR_COUNT):
+            start = time.perf_counter()
+            blocks = self.read_sector(uid, sector, skip_trailer=skip_trailers)
+            sector_times.append(time.perf_counter() - start)
+
+            first = sector_first_block(sector)
+            for offset, block_data in enumerate(blocks):
+                if block_data is not None:
+                    image.set_block(first + offset, block_data)
+            logger.debug("Read sector %d in %.1f ms", sector, sector_times[-1] * 1000)
+        return CardDump(image, sector_times)
+
+    def read_all_blocks(self, uid):
+        """The whole card as a CardImage, blocks that could not be read are not valid in it."""
+        image = self.read_card(uid).image
+        for block_number in image.missing:
+            logger.warning("No data read from Block %d", block_number)
+        return image
+
+    def _validate_write(self, uid, block_number, data):
+        # Validate `uid` type
+        if not isinstance(uid, bytes):
+            logger.error("UID must be of type 'bytes'. Provided type: %s", type(uid))
             return False
 
+        # Validate `data` type and length
+        if not isinstance(data, bytes) or len(data) != BLOCK_SIZE:
+            logger.error(
+                "Data for block %s must be a 'bytes' object of exactly 16 bytes. Provided: type=%s, length=%d",
+                block_number,
+                type(data),
+                len(data) if isinstance(data, bytes) else 0,
+            )
+            return False
+        return True
+
     def write_block(self, uid, block_number, data):
+        if not self._validate_write(uid, block_number, data):
+            return False
         try:
-            authenticated = self._pn532.mifare_classic_authenticate_block(
-                uid, block_number, 0x60, key=DEFAULT_KEY_A
-            )
-            if not authenticated:
-                logger.error("Failed to authenticate block %d for writing", block_number)
-                return False
+            self._attempt(uid, self._write_block_once, uid, block_number, data)
+        except CommandFailed as e:
+            logger.error("Failed to write block %d (%s)", block_number, e)
+            return False
+
+        if self._cache is not None:
+            self._cache.put(uid, block_number, data)
+        logger.info("Successfully wrote data to block %d", block_number)
+        return True
+
+    def _write_block_once(self, uid, block_number, data):
+        self._authenticate(uid, block_number)
+        if not self._write_command(uid, block_number, data):
+            raise CommandFailed("write", f"block {block_number}")
+
+    def write_blocks(self, uid, blocks, verify=False):
+        """
+        Write several blocks given as {block_number: data}, authenticating once
+        per sector. All payloads are validated before anything is written; the
+        manufacturer block and sector trailers are refused.
+        With verify=True every written block is read back under the same sector
+        authentication. Returns {block_number: success}.
+        """
+        results = {block_number: False for block_number in blocks}
+        valid = True
+        for block_number, data in blocks.items():
+            if not isinstance(block_number, int) or not 0 < block_number < BLOCK_COUNT:
+                logger.error("Block number %r is out of range", block_number)
+                valid = False
+            elif is_sector_trailer(block_number):
+                logger.error("Refusing to write sector trailer block %d", block_number)
+                valid = False
+            elif not self._validate_write(uid, block_number, data):
+                valid = False
+        if not valid:
+            return results
+
+        by_sector = {}
+        for block_number in sorted(blocks):
+            by_sector.setdefault(sector_of(block_number), []).append(block_number)
+
+        for sector, block_numbers in by_sector.items():
+            try:
+                self._attempt(uid, self._write_sector_once, uid, sector, block_numbers, blocks, results)
+                authenticated = True
+            except CommandFailed as e:
+                logger.error("Failed to write sector %d (%s)", sector, e)
+                authenticated = False
 
-            success = self._pn532.mifare_classic_write_block(block_number, data)
-            if not success:
-                logger.error("Failed to write to block %d", block_number)
+            if verify:
+                self._verify_sector(uid, sector, block_numbers, blocks, results, authenticated)
+
+        logger.info("Wrote %d of %d blocks", sum(results.values()), len(results))
+        return results
+
+    def _write_sector_once(self, uid, sector, block_numbers, blocks, results):
+        # Blocks written by an earlier attempt are not written again
+        self._authenticate(uid, sector_first_block(sector))
+        for block_number in block_numbers:
+            if results[block_number]:
+                continue
+            if not self._write_command(uid, block_number, blocks[block_number]):
+                raise CommandFailed("write", f"block {block_number}")
+            results[block_number] = True
+            if self._cache is not None:
+                self._cache.put(uid, block_number, blocks[block_number])
+
+    def _verify_sector(self, uid, sector, block_numbers, blocks, results, authenticated):
+        written = [block_number for block_number in block_numbers if results[block_number]]
+        read_back = dict.fromkeys(written)
+        if authenticated:
+            # Still authenticated from writing, try without a new authentication first
+            try:
+                self._read_authenticated(uid, written, read_back)
+            except Exception as e:
+                logger.debug("Reading back sector %d failed: %s", sector, e)
+        missing = [block_number for block_number in written if read_back[block_number] is None]
+        if missing:
+            self._read_sector_blocks(uid, sector, missing, read_back)
+
+        for block_number in written:
+            block_data = read_back[block_number]
+            if block_data is None or bytes(block_data) != blocks[block_number]:
+                logger.error("Verification of block %d failed", block_number)
+                results[block_number] = False
+                if self._cache is not None:
+                    self._cache.invalidate()
+
+    # Asyncio API. All PN532 traffic runs on one worker thread per reader so the
+    # event loop never blocks on SPI and commands to one PN532 never interleave.
+
+    async def run(self, func, *args, **kwargs):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nfc_reader")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _poll_failed(self, error, failures):
+        # A glitch while polling must not end a long-running card iterator:
+        # count it, pause a little longer after every failure in a row and poll again
+        kind = type(error).__name__
+        self.poll_error_counts[kind] += 1
+        POLL_ERRORS.inc(kind)
+        pause = min(POLL_BACKOFF * 2 ** (failures - 1), POLL_BACKOFF_MAX)
+        logger.warning("Polling for cards failed (%s), polling again in %.2f s", error, pause)
+        await asyncio.sleep(pause)
+
+    async def _wait_for_irq(self, irq, timeout, poll_interval):
+        # The PN532 pulls IRQ low once a response (i.e. a card) is ready
+        deadline = time.monotonic() + timeout
+        while irq.value:
+            if time.monotonic() >= deadline:
                 return False
+            await asyncio.sleep(poll_interval)
+        return True
 
-            logger.info("Successfully wrote data to block %d", block_number)
-            return True
-        except Exception as e:
-            logger.exception("Error writing block %d: %s", block_number, e)
-            return False
+    async def next_card(self, irq=None, listen_timeout=1.0, poll_interval=0.01):
+        """
+        Wait until a card is in the field and return its UID.
+        With `irq` (the DigitalInOut wired to the PN532 IRQ pin) only the GPIO is
+        sampled while waiting, otherwise the wait runs on the reader's worker thread.
+        """
+        failures = 0
+        while True:
+            self.polls += 1
+            try:
+                listening = await self.run(self._pn532.listen_for_passive_target, timeout=listen_timeout)
+                if not listening:
+                    await asyncio.sleep(poll_interval)
+                    continue
+                if irq is not None and not await self._wait_for_irq(irq, listen_timeout, poll_interval):
+                    continue
+                uid = await self.run(self.get_passive_target, timeout=listen_timeout)
+            except TRANSIENT_ERRORS as e:
+                failures += 1
+                await self._poll_failed(e, failures)
+                continue
+            failures = 0
+            if uid is not None:
+                self.cards_found += 1
+                return bytes(uid)
+
+    async def cards(self, irq=None, listen_timeout=1.0, poll_interval=0.01):
+        """
+        Async iterator over cards entering the field: `async for uid in reader.cards()`.
+        A card that stays on the reader is reported once; it is reported again
+        after the field has been empty or another card was seen. Driver errors
+        while polling (TRANSIENT_ERRORS) are counted in `poll_error_counts` and
+        polling goes on after a short pause, as in next_card() and card_batches().
+        """
+        last_uid = None
+        failures = 0
+        while True:
+            self.polls += 1
+            try:
+                listening = await self.run(self._pn532.listen_for_passive_target, timeout=listen_timeout)
+                if listening and (irq is None or await self._wait_for_irq(irq, listen_timeout, poll_interval)):
+                    uid = await self.run(self.get_passive_target, timeout=listen_timeout)
+                else:
+                    uid = None
+            except TRANSIENT_ERRORS as e:
+                # Whether the card is still there is unknown, keep last_uid
+                failures += 1
+                await self._poll_failed(e, failures)
+                continue
+            failures = 0
+            if uid is None:
+                last_uid = None
+                continue
+            uid = bytes(uid)
+            if uid == last_uid:
+                await asyncio.sleep(poll_interval)
+                continue
+            last_uid = uid
+            self.cards_found += 1
+            yield uid
+
+    async def card_batches(self, max_targets=MAX_TARGETS, irq=None, listen_timeout=1.0, poll_interval=0.01):
+        """
+        Like cards(), but every poll selects up to `max_targets` cards with one
+        InListPassiveTarget and yields the UIDs of those that newly entered the
+        field as a list. They stay addressable by UID until the next poll. With
+        `irq` the command is only sent and the GPIO sampled until cards answer.
+        """
+        present = set()
+        failures = 0
+        while True:
+            self.polls += 1
+            try:
+                if irq is None:
+                    targets = await self.run(self.list_targets, max_targets, timeout=listen_timeout)
+                elif (await self.run(self.listen_for_targets, max_targets, timeout=listen_timeout)
+                        and await self._wait_for_irq(irq, listen_timeout, poll_interval)):
+                    targets = await self.run(self.get_targets, timeout=listen_timeout)
+                else:
+                    targets = []
+            except TRANSIENT_ERRORS as e:
+                failures += 1
+                await self._poll_failed(e, failures)
+                continue
+            failures = 0
+            uids = [target.uid for target in targets]
+            new = [uid for uid in uids if uid not in present]
+            present = set(uids)
+            if not new:
+                await asyncio.sleep(poll_interval)
+                continue
+            self.cards_found += len(new)
+            yield new
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
 
 if __name__ == "__main__":
 
@@ -169,7 +925,6 @@ if __name__ == "__main__":
     ])
     nfc_reader.write_block(uid = uid_bytes, block_number = 2, data = uid_16)
     
-    blocks_data = nfc_reader.read_all_blocks(uid)
-    for block_number, block_data in enumerate(blocks_data):
-        hex_values = " ".join([f"{byte:02x}" for byte in block_data])
-        logger.info("Data in Block %d: %s", block_number, hex_values)
+    image = nfc_reader.read_all_blocks(uid)
+    for block_number, block_data in image.blocks():
+        logger.info("Data in Block %d: %s", block_number, block_data.hex(" "))
@@ -0,0 +1,415 @@
+# In-memory stand-in for adafruit_pn532's PN532_SPI so NFCReader and the
+# station code can run (and be load-tested) on a machine without a reader.
+from contextlib import nullcontext
+import logging
+import random
+import threading
+import time
+
+
+logger = logging.getLogger("shared_logger")
+
+# Constants
+BLOCK_COUNT = 64
+BLOCK_SIZE = 16
+BLOCKS_PER_SECTOR = 4
+MIFARE_CMD_AUTH_A = 0x60
+MIFARE_CMD_AUTH_B = 0x61
+MIFARE_CMD_READ = 0x30
+MIFARE_CMD_WRITE = 0xA0
+PN532_COMMAND_INDATAEXCHANGE = 0x40
+PN532_COMMAND_INLISTPASSIVETARGET = 0x4A
+# InDataExchange status byte
+STATUS_OK = 0x00
+STATUS_TIMEOUT = 0x01
+STATUS_AUTH_ERROR = 0x14
+# What a MIFARE Classic 1K answers during anticollision
+MIFARE_CLASSIC_1K_SENS_RES = bytes([0x00, 0x04])
+MIFARE_CLASSIC_1K_SEL_RES = 0x08
+FACTORY_KEY = bytes([0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF])
+FACTORY_ACCESS_BITS = bytes([0xFF, 0x07, 0x80, 0x69])
+EMULATED_FIRMWARE = (0x32, 1, 6, 7)
+
+# Rough per-command RF time of a PN532 talking to a MIFARE Classic 1K, in seconds.
+# Use with LatencyModel(rf=TYPICAL_RF_LATENCY) to get realistic cycle times.
+TYPICAL_RF_LATENCY = {
+    "firmware_version": 0.0,
+    "SAM_configuration": 0.0,
+    "get_passive_target": 0.010,
+    # Anticollision and selection of up to two targets
+    "in_list_passive_target": 0.014,
+    "mifare_classic_authenticate_block": 0.006,
+    "mifare_classic_read_block": 0.004,
+    "mifare_classic_write_block": 0.008,
+}
+TYPICAL_SPI_LATENCY = 0.002
+
+
+class LatencyModel:
+    """
+    Delay added to every emulated command: a fixed SPI frame overhead, split
+    between the command and the response transfer, plus a per-command RF time
+    and optional uniform jitter that the chip spends off the bus.
+    """
+
+    def __init__(self, spi=0.0, rf=None, jitter=0.0, seed=None):
+        self.spi = spi
+        self.rf = dict(rf or {})
+        self.jitter = jitter
+        self._random = random.Random(seed)
+
+    @classmethod
+    def typical(cls, jitter=0.001, seed=None):
+        return cls(spi=TYPICAL_SPI_LATENCY, rf=TYPICAL_RF_LATENCY, jitter=jitter, seed=seed)
+
+    def transfer(self):
+        if self.spi > 0:
+            time.sleep(self.spi / 2)
+
+    def processing(self, command):
+        seconds = self.rf.get(command, 0.0)
+        if self.jitter:
+            seconds += self._random.uniform(0, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class FaultModel:
+    """
+    Injected failures for authentication, reads and writes, and garbled response
+    frames ("frame") on which the driver raises like on a CRC error. Failures are
+    drawn at the configured rates, and inject() forces the next N calls of a
+    command to fail so retry paths can be exercised deterministically.
+    """
+
+    def __init__(self, auth_failure_rate=0.0, read_failure_rate=0.0,
+                 write_failure_rate=0.0, frame_error_rate=0.0, seed=None):
+        self.rates = {
+            "mifare_classic_authenticate_block": auth_failure_rate,
+            "mifare_classic_read_block": read_failure_rate,
+            "mifare_classic_write_block": write_failure_rate,
+            "frame": frame_error_rate,
+        }
+        self._forced = {}
+        self._random = random.Random(seed)
+
+    def inject(self, command, count=1):
+        self._forced[command] = self._forced.get(command, 0) + count
+
+    def should_fail(self, command):
+        forced = self._forced.get(command, 0)
+        if forced:
+            self._forced[command] = forced - 1
+            return True
+        rate = self.rates.get(command, 0.0)
+        return rate > 0 and self._random.random() < rate
+
+
+class VirtualCard:
+    """A MIFARE Classic 1K card held in memory, with factory keys by default."""
+
+    def __init__(self, uid, data=None):
+        self.uid = bytes(uid)
+        if data is None:
+            data = bytearray(BLOCK_COUNT * BLOCK_SIZE)
+            data[0:len(self.uid)] = self.uid
+            for sector in range(BLOCK_COUNT // BLOCKS_PER_SECTOR):
+                self._set_trailer(data, sector, FACTORY_KEY, FACTORY_KEY)
+        if len(data) != BLOCK_COUNT * BLOCK_SIZE:
+            raise ValueError("Card data must be %d bytes" % (BLOCK_COUNT * BLOCK_SIZE))
+        self.data = bytearray(data)
+
+    @staticmethod
+    def _set_trailer(data, sector, key_a, key_b):
+        start = (sector * BLOCKS_PER_SECTOR + BLOCKS_PER_SECTOR - 1) * BLOCK_SIZE
+        data[start:start + BLOCK_SIZE] = key_a + FACTORY_ACCESS_BITS + key_b
+
+    def key(self, sector, key_number):
+        start = (sector * BLOCKS_PER_SECTOR + BLOCKS_PER_SECTOR - 1) * BLOCK_SIZE
+        if key_number == MIFARE_CMD_AUTH_A:
+            return bytes(self.data[start:start + 6])
+        return bytes(self.data[start + 10:start + 16])
+
+    def block(self, block_number):
+        start = block_number * BLOCK_SIZE
+        block = bytearray(self.data[start:start + BLOCK_SIZE])
+        if block_number % BLOCKS_PER_SECTOR == BLOCKS_PER_SECTOR - 1:
+            # Key A is never readable, the chip returns zeros instead
+            block[0:6] = bytes(6)
+        return block
+
+    def set_block(self, block_number, data):
+        start = block_number * BLOCK_SIZE
+        self.data[start:start + BLOCK_SIZE] = data
+
+    def __repr__(self):
+        return "VirtualCard(%s)" % self.uid.hex(":")
+
+
+class EmulatedIRQ:
+    """
+    Stand-in for the PN532 IRQ pin: low while a listen command has a card ready,
+    which takes the RF time of get_passive_target after the listen was sent.
+    """
+
+    def __init__(self, pn532):
+        self._pn532 = pn532
+
+    @property
+    def value(self):
+        pn532 = self._pn532
+        with pn532._lock:
+            if not (pn532._listening and pn532._field):
+                return True
+            detection = pn532.latency.rf.get("get_passive_target", 0.0)
+            return time.monotonic() - pn532._listen_started < detection
+
+
+class EmulatedPN532:
+    """
+    Implements the subset of the PN532_SPI API that NFCReader and the stations
+    use. Cards are put into and taken out of the RF field with place_card() and
+    remove_card(); read_passive_target() selects the first card in the field.
+    call_function() understands InListPassiveTarget for up to two targets and
+    the MIFARE Classic InDataExchange commands addressed by target number;
+    InListPassiveTarget can also be split into send_command() and
+    process_response(), as with the IRQ pin.
+    """
+
+    def __init__(self, cards=None, latency=None, faults=None):
+        self.latency = latency or LatencyModel()
+        self.faults = faults or FaultModel()
+        self.command_counts = {}
+        self._field = list(cards or [])
+        # Target number -> selected card and -> authenticated sector
+        self._targets = {}
+        self._authenticated = {}
+        self._listening = False
+        self._listen_started = 0.0
+        # Targets the pending listen selects, 1 for listen_for_passive_target()
+        self._listen_targets = 1
+        self._lock = threading.RLock()
+        self._card_present = threading.Condition(self._lock)
+        self.irq = EmulatedIRQ(self)
+        # Like PN532_SPI's SPIDevice; reader_manager wraps it to share the bus
+        self._spi = nullcontext()
+
+    # Field handling
+
+    @property
+    def cards_in_field(self):
+        with self._lock:
+            return list(self._field)
+
+    def place_card(self, card):
+        with self._lock:
+            if card not in self._field:
+                self._field.append(card)
+            self._card_present.notify_all()
+
+    def remove_card(self, card=None):
+        with self._lock:
+            if card is None:
+                self._field.clear()
+            elif card in self._field:
+                self._field.remove(card)
+            for number, selected in list(self._targets.items()):
+                if selected not in self._field:
+                    self._release(number)
+
+    def _select(self, max_targets, timeout):
+        # Waits like the PN532 for a card, then selects up to max_targets of them
+        if not self._field:
+            self._card_present.wait_for(lambda: self._field, timeout=timeout)
+        self._targets = {number: card for number, card in enumerate(self._field[:max_targets], start=1)}
+        self._authenticated = {}
+        return list(self._targets.values())
+
+    def _release(self, number):
+        # Like a real card: after an error it has to be selected again
+        self._targets.pop(number, None)
+        self._authenticated.pop(number, None)
+
+    # PN532 commands
+
+    def _command(self, name):
+        self.command_counts[name] = self.command_counts.get(name, 0) + 1
+        # Command frame, RF exchange on the chip, response frame
+        with self._spi:
+            self.latency.transfer()
+        self.latency.processing(name)
+        with self._spi:
+            self.latency.transfer()
+        if name.startswith("mifare_classic") and self.faults.should_fail("frame"):
+            raise RuntimeError("Response checksum did not match expected value")
+
+    @property
+    def firmware_version(self):
+        self._command("firmware_version")
+        return EMULATED_FIRMWARE
+
+    def SAM_configuration(self):
+        self._command("SAM_configuration")
+
+    def read_passive_target(self, card_baud=0x00, timeout=1):
+        if not self.listen_for_passive_target(card_baud=card_baud, timeout=timeout):
+            return None
+        return self.get_passive_target(timeout=timeout)
+
+    def listen_for_passive_target(self, card_baud=0x00, timeout=1):
+        self._command("listen_for_passive_target")
+        with self._lock:
+            self._listen(1)
+        return True
+
+    def _listen(self, max_targets):
+        self._listening = True
+        self._listen_started = time.monotonic()
+        self._listen_targets = min(max_targets, 2)
+
+    def get_passive_target(self, timeout=1):
+        with self._lock:
+            if not self._listening:
+                return None
+            selected = self._select(1, timeout)
+            if not selected:
+                # Like the PN532, keep listening until a card shows up
+                return None
+            self._listening = False
+        self._command("get_passive_target")
+        return bytearray(selected[0].uid)
+
+    def mifare_classic_authenticate_block(self, uid, block_number, key_number, key):
+        return self._authenticate(1, uid, block_number, key_number, key)
+
+    def mifare_classic_read_block(self, block_number):
+        return self._read(1, block_number)
+
+    def mifare_classic_write_block(self, block_number, data):
+        assert data is not None and len(data) == 16, "Data must be an array of 16 bytes!"
+        return self._write(1, block_number, data)
+
+    def call_function(self, command, response_length=0, params=b"", timeout=1):
+        """Raw command frames, returns the response bytes after the command code."""
+        params = bytes(params)
+        if command == PN532_COMMAND_INLISTPASSIVETARGET:
+            return self._in_list_passive_target(params[0], timeout)
+        if command == PN532_COMMAND_INDATAEXCHANGE:
+            return self._in_data_exchange(params)
+        raise NotImplementedError("Command 0x%02X is not emulated" % command)
+
+    def send_command(self, command, params=b"", timeout=1):
+        """Only InListPassiveTarget: start listening, the cards are fetched with process_response()."""
+        if command != PN532_COMMAND_INLISTPASSIVETARGET:
+            raise NotImplementedError("Command 0x%02X is not emulated without its response" % command)
+        self._command("listen_for_passive_target")
+        with self._lock:
+            self._listen(bytes(params)[0])
+        return True
+
+    def process_response(self, command, response_length=0, timeout=1):
+        """The InListPassiveTarget response to the last send_command(), None while no card answered."""
+        if command != PN532_COMMAND_INLISTPASSIVETARGET:
+            raise NotImplementedError("Command 0x%02X is not emulated without its response" % command)
+        with self._lock:
+            if not self._listening:
+                return None
+            selected = self._select(self._listen_targets, timeout)
+            if not selected:
+                # Like the PN532, keep listening until a card shows up
+                return None
+            self._listening = False
+        self._command("in_list_passive_target")
+        return self._target_list(selected)
+
+    def _in_list_passive_target(self, max_targets, timeout):
+        with self._lock:
+            self._listening = False
+            selected = self._select(min(max_targets, 2), timeout)
+            if not selected:
+                # No response frame within the timeout
+                return None
+        self._command("in_list_passive_target")
+        return self._target_list(selected)
+
+    @staticmethod
+    def _target_list(selected):
+        response = bytearray([len(selected)])
+        for number, card in enumerate(selected, start=1):
+            response += bytes([number]) + MIFARE_CLASSIC_1K_SENS_RES + bytes([MIFARE_CLASSIC_1K_SEL_RES, len(card.uid)])
+            response += card.uid
+        return response
+
+    def _in_data_exchange(self, params):
+        number, mifare_command, block_number = params[0], params[1], params[2]
+        if mifare_command in (MIFARE_CMD_AUTH_A, MIFARE_CMD_AUTH_B):
+            ok = self._authenticate(number, params[9:], block_number, mifare_command, params[3:9])
+            return bytearray([STATUS_OK if ok else STATUS_AUTH_ERROR])
+        if mifare_command == MIFARE_CMD_READ:
+            block = self._read(number, block_number)
+            return bytearray([STATUS_TIMEOUT]) if block is None else bytearray([STATUS_OK]) + block
+        if mifare_command == MIFARE_CMD_WRITE:
+            ok = self._write(number, block_number, params[3:19])
+            return bytearray([STATUS_OK if ok else STATUS_TIMEOUT])
+        raise NotImplementedError("MIFARE command 0x%02X is not emulated" % mifare_command)
+
+    def _authenticate(self, number, uid, block_number, key_number, key):
+        self._command("mifare_classic_authenticate_block")
+        with self._lock:
+            card = self._targets.get(number)
+            self._authenticated.pop(number, None)
+            if card is None or card not in self._field or bytes(uid) != card.uid:
+                return False
+            sector = block_number // BLOCKS_PER_SECTOR
+            if self.faults.should_fail("mifare_classic_authenticate_block") or bytes(key) != card.key(sector, key_number):
+                self._release(number)
+                return False
+            self._authenticated[number] = sector
+            return True
+
+    def _authenticated_for(self, number, block_number):
+        card = self._targets.get(number)
+        if card is None or card not in self._field:
+            return None
+        if self._authenticated.get(number) != block_number // BLOCKS_PER_SECTOR:
+            return None
+        return card
+
+    def _read(self, number, block_number):
+        self._command("mifare_classic_read_block")
+        with self._lock:
+            card = self._authenticated_for(number, block_number)
+            if card is None or self.faults.should_fail("mifare_classic_read_block"):
+                # The card goes idle after an error and has to be selected and authenticated again
+                self._release(number)
+                return None
+            return card.block(block_number)
+
+    def _write(self, number, block_number, data):
+        self._command("mifare_classic_write_block")
+        with self._lock:
+            card = self._authenticated_for(number, block_number)
+            if card is None or block_number == 0 or self.faults.should_fail("mifare_classic_write_block"):
+                self._release(number)
+                return False
+            card.set_block(block_number, data)
+            return True
+
+
+if __name__ == "__main__":
+    from nfc_reader import NFCReader
+
+    logging.basicConfig(level=logging.INFO)
+    cards = [VirtualCard(bytes([0x93, 0x5F, 0xA7, 0x91])), VirtualCard(bytes([0x2D, 0xA2, 0xC1, 0x38]))]
+    emulator = EmulatedPN532(cards, latency=LatencyModel.typical(seed=1))
+    reader = NFCReader(pn532=emulator)
+
+    for card in cards:
+        emulator.remove_card()
+        emulator.place_card(card)
+        uid = reader.read_passive_target(timeout=0.5)
+        start = time.perf_counter()
+        dump = reader.read_card(uid)
+        logger.info("Read card %s in %.1f ms, missing blocks: %s",
+                    bytes(uid).hex(":"), (time.perf_counter() - start) * 1000, dump.image.missing)
+    logger.info("Commands sent: %s", emulator.command_counts)